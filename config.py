@@ -107,6 +107,8 @@ current_data_directory = monthly_data_directory
 current_graph_directory = monthly_data_directory
 # Summary with statistics for the night
 summary_data_directory = monthly_data_directory
+# Cached computations (ephemerids, sun altitudes...). Can be deleted.
+cache_directory = monthly_data_directory+"/cache"
 
 '''
 ----------------------------
@@ -139,6 +141,65 @@ _mysql_dbtable = None
 _mysql_port = None
 
 
+'''
+---------------------------------
+Runtime metrics (OPTIONAL)
+---------------------------------
+'''
+
+# File with the metrics (Prometheus text format). None to disable.
+_metrics_file = None
+# Seconds between two updates of the metrics file.
+_metrics_interval = 60
+# Local HTTP port to serve the metrics (http://127.0.0.1:port/metrics).
+# None to disable.
+_metrics_port = None
+# Profiling reports (kill -USR1 / kill -USR2 <pid>) are saved here.
+_profiling_directory = monthly_data_directory+"/profiling"
+# Duration (seconds) of the cProfile runs started with SIGUSR1.
+_profiling_seconds = 60
+
+
+'''
+---------------------------------
+HTTP data server (OPTIONAL)
+---------------------------------
+'''
+
+# Local HTTP port to serve the data and plots (http://127.0.0.1:port/latest,
+# /night, /night.csv, /data?from=..&to=.., /images). None to disable.
+_api_port = None
+# Address to listen on. Use '0.0.0.0' to allow other computers.
+_api_host = '127.0.0.1'
+# Number of responses (and archive files) kept in memory.
+_api_cache_size = 64
+
+
+'''
+---------------------------------
+Live samples ring buffer (OPTIONAL)
+---------------------------------
+'''
+
+# Memory mapped file with the last samples, for other programs in the
+# computer (see pysqm/ringbuffer.py for the format). None to disable.
+_ringbuffer_file = None
+# Number of samples kept in the file.
+_ringbuffer_capacity = 100000
+
+
+'''
+---------------------------------
+Live samples broadcast (OPTIONAL)
+---------------------------------
+'''
+
+# Unix domain socket where local programs subscribe to the samples
+# (see pysqm/publish.py). None to disable.
+_publish_socket = None
+# UDP multicast 'group:port' (p.e. '239.255.42.99:5599'). None to disable.
+_publish_multicast = None
+
 
 '''
 ---------------
@@ -153,6 +214,20 @@ limits_nsb = [15,22]
 limits_time   = [17,9]
 # Limits in the Sun altitude for the plot. In degrees.
 limits_sunalt = [-90,5]
+# Resolution of the plots (dots per inch)
+plot_dpi = 150
+# Reduce the plotted points to the ones visible at that resolution
+# (min/max per pixel column). Keeps the plotting time flat for long
+# or high-rate data.
+plot_downsampling = True
+# Long-term heatmap (nights vs local time, median NSB), updated each
+# time the statistics of a night are written. Size of the time bins
+# in minutes.
+plot_heatmap = True
+heatmap_bin_minutes = 10
+# Also write a thumbnail (<name>_thumb.png) of each plot, at most this
+# width in pixels. None to disable.
+plot_thumbnail_width = None
 
 
 
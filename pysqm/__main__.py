@@ -26,6 +26,7 @@ ____________________________
 #from types import ModuleType
 #import sys
 
+import time
 import pysqm.main as main
 
 while(1==1):
@@ -39,4 +40,5 @@ while(1==1):
         print(e)
         print('Trying to restart')
         print('')
+        main.StartupTime = time.time()
 
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+'''
+PySQM vectorized Sun and Moon positions
+____________________________
+
+Copyright (c) Miguel Nievas <miguelnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Altitude and azimuth of the Sun and the Moon for a whole array of
+UTC datetime64 at once, instead of one pyephem call per data line.
+Low precision formulae from the Astronomical Almanac (section C and D).
+Altitudes include the atmospheric refraction, with the pyephem model
+and its default pressure (1010 mB) and temperature (15 C).
+
+Tolerance with respect to pyephem (years 1960-2040):
+ - Sun:  0.03 deg in altitude and azimuth.
+ - Moon: 0.5 deg in altitude and azimuth (lunar theory truncated to
+   the main terms, topocentric parallax included).
+Azimuth differences are measured on the sky (multiplied by cos(alt)).
+Run this module to check it, and the error of SunAltitudeTable
+(python -m pysqm.astro).
+____________________________
+'''
+
+import numpy as np
+
+from pysqm.cache import load_array,save_array
+
+SUN_TOLERANCE  = 0.03
+MOON_TOLERANCE = 0.5
+
+# Julian date of 1970-01-01T00:00:00 (datetime64 epoch)
+JD_UNIX_EPOCH = 2440587.5
+JD_J2000 = 2451545.0
+
+
+def julian_date(utcdates):
+    ''' Julian date of an array of UTC datetime64 (or datetime) '''
+    utcdates = np.asarray(utcdates,dtype='datetime64[s]')
+    seconds = utcdates.astype('int64').astype(float)
+    return(JD_UNIX_EPOCH+seconds/86400.)
+
+
+def local_sidereal_time(jd,longitude):
+    ''' Local mean sidereal time (radians). Longitude in degrees, East>0 '''
+    gmst = 18.697374558+24.06570982441908*(jd-JD_J2000)
+    return(np.radians(np.mod(gmst*15.+longitude,360.)))
+
+
+def sun_equatorial(jd):
+    ''' Sun apparent right ascension and declination (radians) '''
+    n = jd-JD_J2000
+    L = np.radians(np.mod(280.460+0.9856474*n,360.))
+    g = np.radians(np.mod(357.528+0.9856003*n,360.))
+    ecl_lon = L+np.radians(1.915*np.sin(g)+0.020*np.sin(2*g))
+    obliquity = np.radians(23.439-0.0000004*n)
+    ra  = np.arctan2(np.cos(obliquity)*np.sin(ecl_lon),np.cos(ecl_lon))
+    dec = np.arcsin(np.sin(obliquity)*np.sin(ecl_lon))
+    return(ra,dec)
+
+
+def moon_equatorial(jd):
+    '''
+    Moon geocentric right ascension, declination and
+    horizontal parallax (radians)
+    '''
+    T = (jd-JD_J2000)/36525.
+    def sind(x): return(np.sin(np.radians(x)))
+    def cosd(x): return(np.cos(np.radians(x)))
+
+    ecl_lon = 218.32+481267.881*T\
+     +6.29*sind(135.0+477198.87*T)-1.27*sind(259.3-413335.36*T)\
+     +0.66*sind(235.7+890534.22*T)+0.21*sind(269.9+954397.74*T)\
+     -0.19*sind(357.5+35999.05*T)-0.11*sind(186.5+966404.03*T)
+    ecl_lat = 5.13*sind(93.3+483202.02*T)+0.28*sind(228.2+960400.89*T)\
+     -0.28*sind(318.3+6003.15*T)-0.17*sind(217.6-407332.21*T)
+    parallax = 0.9508+0.0518*cosd(135.0+477198.87*T)\
+     +0.0095*cosd(259.3-413335.36*T)+0.0078*cosd(235.7+890534.22*T)\
+     +0.0028*cosd(269.9+954397.74*T)
+
+    ecl_lon = np.radians(ecl_lon)
+    ecl_lat = np.radians(ecl_lat)
+    obliquity = np.radians(23.439-0.0000004*(jd-JD_J2000))
+
+    # Ecliptic to equatorial
+    x = np.cos(ecl_lat)*np.cos(ecl_lon)
+    y = np.cos(obliquity)*np.cos(ecl_lat)*np.sin(ecl_lon)\
+     -np.sin(obliquity)*np.sin(ecl_lat)
+    z = np.sin(obliquity)*np.cos(ecl_lat)*np.sin(ecl_lon)\
+     +np.cos(obliquity)*np.sin(ecl_lat)
+    ra  = np.arctan2(y,x)
+    dec = np.arcsin(z)
+    return(ra,dec,np.radians(parallax))
+
+
+def unrefract(apparent,pressure=1010.,temperature=15.):
+    '''
+    True altitude from the apparent altitude (radians).
+    Same model as pyephem (libastro): a fit for altitudes below 15 deg,
+    that goes to 0 some degrees below the horizon, and the usual cot(alt)
+    law above. Both are blended between 14.5 and 15.5 deg.
+    '''
+    def lt15(aa):
+        aadeg = np.degrees(aa)
+        a = ((2e-5*aadeg+1.96e-2)*aadeg+.1594)*pressure
+        b = (273+temperature)*((8.45e-2*aadeg+5.05e-1)*aadeg+1)
+        r = np.radians(a/b)
+        return(np.where((aa<0)*(r<0),aa,aa-r))
+
+    def ge15(aa):
+        return(aa-7.888888e-5*pressure/((273+temperature)*np.tan(aa)))
+
+    alo,ahi = np.radians(14.5),np.radians(15.5)
+    tlo,thi = lt15(alo),ge15(ahi)
+    with np.errstate(all='ignore'):
+        true_alt = np.where(apparent<alo,lt15(apparent),\
+         np.where(apparent>=ahi,ge15(apparent),\
+          tlo+(thi-tlo)*(apparent-alo)/(ahi-alo)))
+    return(true_alt)
+
+
+def refract(altitude,pressure=1010.,temperature=15.):
+    '''
+    Apparent altitude from the true altitude (radians).
+    Inverse of unrefract, solved by bisection for the whole array
+    (refraction is always below 2 deg).
+    '''
+    low  = np.array(altitude,dtype=float)
+    high = low+np.radians(2.)
+    for step in range(30):
+        middle = 0.5*(low+high)
+        above = unrefract(middle,pressure,temperature)>altitude
+        high = np.where(above,middle,high)
+        low  = np.where(above,low,middle)
+    return(0.5*(low+high))
+
+
+def horizontal_vector(ra,dec,jd,latitude,longitude):
+    ''' Equatorial coordinates to a unit vector (north, east, up) '''
+    lat = np.radians(latitude)
+    hour_angle = local_sidereal_time(jd,longitude)-ra
+    north = np.sin(dec)*np.cos(lat)-np.cos(dec)*np.cos(hour_angle)*np.sin(lat)
+    east = -np.cos(dec)*np.sin(hour_angle)
+    up = np.sin(lat)*np.sin(dec)+np.cos(lat)*np.cos(dec)*np.cos(hour_angle)
+    return(north,east,up)
+
+
+def horizontal(ra,dec,jd,latitude,longitude):
+    ''' Equatorial to horizontal coordinates (radians) '''
+    north,east,up = horizontal_vector(ra,dec,jd,latitude,longitude)
+    altitude = np.arcsin(up)
+    # Azimuth from North, through East
+    azimuth = np.arctan2(east,north)
+    return(altitude,np.mod(azimuth,2*np.pi))
+
+
+def sun_altaz(utcdates,latitude,longitude,refraction=True):
+    '''
+    Sun altitude and azimuth (radians) for an array of UTC dates.
+    Latitude and longitude of the observatory in degrees.
+    '''
+    jd = julian_date(utcdates)
+    ra,dec = sun_equatorial(jd)
+    altitude,azimuth = horizontal(ra,dec,jd,latitude,longitude)
+    if refraction: altitude = refract(altitude)
+    return(altitude,azimuth)
+
+
+def moon_altaz(utcdates,latitude,longitude,refraction=True):
+    '''
+    Moon topocentric altitude and azimuth (radians) for an array of
+    UTC dates. Latitude and longitude of the observatory in degrees.
+    '''
+    jd = julian_date(utcdates)
+    ra,dec,parallax = moon_equatorial(jd)
+    altitude,azimuth = horizontal(ra,dec,jd,latitude,longitude)
+    # Parallax in altitude (the observer is not at the Earth center)
+    altitude = altitude-np.arcsin(np.sin(parallax)*np.cos(altitude))
+    if refraction: altitude = refract(altitude)
+    return(altitude,azimuth)
+
+
+class SunAltitudeTable(object):
+    '''
+    Sun position computed once per night at a coarse grid and
+    interpolated (np.interp) for each data point.
+
+    The direction of the Sun (north, east, up unit vector) is
+    interpolated instead of the altitude, which has a cusp when the
+    Sun passes close to the zenith or nadir. The refraction is then
+    applied from a fine table of apparent vs true altitude.
+
+    Each table covers 24 h from local solar noon, so every timestamp
+    belongs to exactly one night. Tables are kept in memory and, if a
+    directory is given, saved there (one .npy file per night) to be
+    reused by later runs. The directory must be specific to the site.
+
+    Error with respect to sun_altaz with the default 1 minute grid,
+    measured for a year at latitudes -89 to 89 (zenith and nadir
+    passages included): below ERROR_BOUND deg.
+    '''
+    ERROR_BOUND = 0.001
+
+    # Step (deg) of the refraction table
+    REFRACTION_STEP = 0.01
+
+    def __init__(self,latitude,longitude,directory=None,resolution=60,max_nights=32):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.directory = directory
+        self.resolution = int(resolution)
+        self.max_nights = max_nights
+        self.grid = np.arange(0,86400+self.resolution,self.resolution)
+        # Seconds from UTC to local solar time minus 12h
+        self.offset = int(round(longitude*240.))-43200
+        self.tables = {}
+        self.refraction = None
+
+    def night_starts(self,seconds):
+        # Start (UTC seconds) of the night each timestamp belongs to
+        return((seconds+self.offset)//86400*86400-self.offset)
+
+    def table(self,start):
+        '''
+        Sun direction (N x 3 array: north, east, up) in the grid
+        for the night starting at start
+        '''
+        try:
+            return(self.tables[start])
+        except KeyError:
+            pass
+
+        filename = None
+        vectors = None
+        if self.directory is not None:
+            night = np.datetime64(int(start+self.offset+43200),'s').astype('datetime64[D]')
+            filename = '%s/sunvec_%s_%ds.npy' \
+             %(self.directory,str(night).replace('-',''),self.resolution)
+            vectors = load_array(filename)
+
+        if vectors is None or np.shape(vectors)!=(np.size(self.grid),3):
+            jd = julian_date((start+self.grid).astype('datetime64[s]'))
+            ra,dec = sun_equatorial(jd)
+            vectors = np.transpose(horizontal_vector(\
+             ra,dec,jd,self.latitude,self.longitude))
+            if filename is not None:
+                save_array(filename,vectors)
+
+        if len(self.tables)>=self.max_nights:
+            self.tables.clear()
+        self.tables[start] = vectors
+        return(vectors)
+
+    def refraction_table(self):
+        # True altitudes and their apparent altitudes (radians)
+        if self.refraction is None:
+            true_alt = np.radians(np.arange(-90,90+self.REFRACTION_STEP,\
+             self.REFRACTION_STEP))
+            self.refraction = (true_alt,refract(true_alt))
+        return(self.refraction)
+
+    def altitude(self,utcdates):
+        ''' Sun altitude (radians) for an array of UTC dates '''
+        seconds = np.asarray(utcdates,dtype='datetime64[s]').astype('int64')
+        starts = self.night_starts(seconds)
+        altitudes = np.empty(np.shape(seconds))
+        for start in np.unique(starts):
+            selection = starts==start
+            vectors = self.table(int(start))
+            north,east,up = [np.interp(seconds[selection]-start,\
+             self.grid,vectors[:,k]) for k in range(3)]
+            altitudes[selection] = np.arctan2(up,np.hypot(north,east))
+        true_alt,apparent_alt = self.refraction_table()
+        return(np.interp(altitudes,true_alt,apparent_alt))
+
+
+def compare_with_ephem(utcdates,latitude,longitude):
+    '''
+    Max absolute differences (deg) with pyephem in
+    (sun alt, sun az, moon alt, moon az)
+    '''
+    import ephem
+    OBS = ephem.Observer()
+    OBS.lat = np.radians(latitude)
+    OBS.lon = np.radians(longitude)
+    reference = []
+    for utcdate in np.asarray(utcdates,dtype='datetime64[s]').astype(object):
+        OBS.date = ephem.date(utcdate)
+        Sun  = ephem.Sun(OBS)
+        Moon = ephem.Moon(OBS)
+        reference.append([Sun.alt,Sun.az,Moon.alt,Moon.az])
+    reference = np.array(reference)
+
+    def angle_diff(a,b,weight=1.):
+        return(np.max(weight*np.abs(np.degrees(np.angle(np.exp(1j*(a-b)))))))
+
+    sun_alt,sun_az = sun_altaz(utcdates,latitude,longitude)
+    moon_alt,moon_az = moon_altaz(utcdates,latitude,longitude)
+    # Azimuth differences measured on the sky (x cos(alt))
+    return(\
+     angle_diff(sun_alt,reference[:,0]),\
+     angle_diff(sun_az,reference[:,1],np.cos(reference[:,0])),\
+     angle_diff(moon_alt,reference[:,2]),\
+     angle_diff(moon_az,reference[:,3],np.cos(reference[:,2])))
+
+
+if __name__ == '__main__':
+    # Validate the engine against pyephem
+    utcdates = np.arange(\
+     np.datetime64('1960-01-01T00:00:00'),np.datetime64('2040-01-01T00:00:00'),\
+     np.timedelta64(86400*7+3607,'s'))
+    for latitude,longitude in [(40.45,-3.73),(-30.2,-70.8),(64.1,-21.9),(19.8,-155.5)]:
+        errors = compare_with_ephem(utcdates,latitude,longitude)
+        print('Lat %6.2f Lon %7.2f. Max diff (deg) Sun alt/az: %.3f %.3f, '\
+         'Moon alt/az: %.3f %.3f' %((latitude,longitude)+errors))
+        assert(max(errors[0:2])<SUN_TOLERANCE)
+        assert(max(errors[2:4])<MOON_TOLERANCE)
+    print('OK. Sun within %.2f deg, Moon within %.2f deg of pyephem' \
+     %(SUN_TOLERANCE,MOON_TOLERANCE))
+
+    # Interpolation of the Sun altitude tables
+    utcdates = np.arange(\
+     np.datetime64('2020-01-01T00:00:00'),np.datetime64('2021-01-01T00:00:00'),\
+     np.timedelta64(97,'s'))
+    for latitude,longitude in [(19.8,-155.5),(23.0,0.0),(0.0,0.0),(-89.0,0.0)]:
+        error = np.max(np.abs(np.degrees(\
+         SunAltitudeTable(latitude,longitude).altitude(utcdates)-\
+         sun_altaz(utcdates,latitude,longitude)[0])))
+        print('Lat %6.2f Lon %7.2f. Max diff (deg) of the Sun altitude table: %.4f' \
+         %(latitude,longitude,error))
+        assert(error<SunAltitudeTable.ERROR_BOUND)
+    print('OK. Sun altitude tables within %.3f deg' %SunAltitudeTable.ERROR_BOUND)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+'''
+PySQM disk and memory caches
+____________________________
+
+Copyright (c) Miguel Nievas <miguelnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Everything stored under config.cache_directory can be recomputed,
+the directory can be safely deleted.
+____________________________
+'''
+
+import os,sys
+import errno
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict
+
+import pysqm.settings as settings
+
+
+def cache_directory(*subdirs):
+    '''
+    Return (and create if needed) a directory inside the cache.
+    '''
+    config = settings.GlobalConfig.config
+    try: config.cache_directory
+    except: config.cache_directory = config.monthly_data_directory+'/cache'
+
+    directory = os.path.join(config.cache_directory,*subdirs)
+    make_directory(directory)
+    return(directory)
+
+
+def make_directory(directory):
+    # Create a directory (and its parents) if needed. Other processes
+    # (p.e. the reprocess workers) may be creating it at the same time.
+    try: os.makedirs(directory)
+    except OSError as e:
+        if e.errno!=errno.EEXIST or not os.path.isdir(directory): raise
+
+
+def site_key(latitude,longitude):
+    # Directory name for a site, p.e. +40.4500_-003.7300
+    return('%+08.4f_%+09.4f' %(latitude,longitude))
+
+
+def replace_file(source,destination):
+    # Rename source to destination, overwriting it.
+    # Windows doesnt allow to rename over an existing file.
+    try: os.rename(source,destination)
+    except OSError:
+        os.remove(destination)
+        os.rename(source,destination)
+
+
+# Permissions of the new files (temp files are created with 0600)
+_umask = os.umask(0)
+os.umask(_umask)
+
+def file_mode(filename):
+    # Keep the permissions of the file if it exists
+    try: return(os.stat(filename).st_mode&0o777)
+    except OSError: return(0o666&~_umask)
+
+
+def write_file(filename,write,mode='wb'):
+    '''
+    Call write(file) on a new temp file in the same directory and
+    rename it to filename, so readers never see a partial file.
+    The temp name is unique, parallel writers dont clobber it.
+    '''
+    fd,tmp_filename = tempfile.mkstemp(prefix=os.path.basename(filename)+'.',\
+     suffix='.tmp',dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        tmp_file = os.fdopen(fd,mode)
+        try: write(tmp_file)
+        finally: tmp_file.close()
+        os.chmod(tmp_filename,file_mode(filename))
+        replace_file(tmp_filename,filename)
+    except:
+        if os.path.exists(tmp_filename): os.remove(tmp_filename)
+        raise
+
+
+def save_bytes(filename,content):
+    write_file(filename,lambda tmp_file: tmp_file.write(content))
+
+
+def save_array(filename,array):
+    write_file(filename,lambda tmp_file: np.save(tmp_file,array))
+
+
+def load_array(filename):
+    # Return None if the file doesnt exist or is not valid
+    try: return(np.load(filename))
+    except: return(None)
+
+
+class LRUCache(object):
+    '''
+    Dict-like memory cache that keeps only the maxsize
+    most recently used items. Thread safe.
+    '''
+    def __init__(self,maxsize=128):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self,key,default=None):
+        with self.lock:
+            try: value = self.items.pop(key)
+            except KeyError: return(default)
+            self.items[key] = value
+            return(value)
+
+    def put(self,key,value):
+        with self.lock:
+            self.items.pop(key,None)
+            self.items[key] = value
+            while len(self.items)>self.maxsize:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
@@ -26,6 +26,7 @@ ____________________________
 import math
 import ephem
 import datetime
+import pysqm.astro as astro
 
 # Read the config variables from config.py
 import pysqm.settings as settings
@@ -79,10 +80,10 @@ class observatory(object):
         return(utc_dt + datetime.timedelta(hours=config._local_timezone))
 
     def calculate_sun_altitude(self,OBS,timeutc):
-        # Calculate Sun altitude
-        OBS.date = ephem.date(timeutc)
-        Sun = ephem.Sun(OBS)
-        return(Sun.alt)
+        # Calculate Sun altitude (radians) with the vectorized engine
+        sun_altitude,sun_azimuth = astro.sun_altaz(timeutc,\
+         float(OBS.lat)*180./ephem.pi,float(OBS.lon)*180./ephem.pi)
+        return(float(sun_altitude))
 
     def next_sunset(self,OBS):
         # Next sunset calculation
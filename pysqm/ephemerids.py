@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+'''
+PySQM Moon and twilight ephemerids
+____________________________
+
+Copyright (c) Miguel Nievas <miguelnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Used by the plots and by the daemon (night statistics during the
+acquisition), so it doesnt import matplotlib.
+____________________________
+'''
+
+import os,sys
+import json
+import ephem
+import datetime
+
+from pysqm.common import define_ephem_observatory
+import pysqm.cache as cache
+
+'''
+Read configuration
+'''
+import pysqm.settings as settings
+config = settings.GlobalConfig.config
+
+
+# Origin of the ephem dates (Dublin Julian Day 0)
+EPHEM_EPOCH = datetime.datetime(1899,12,31,12,0,0)
+
+
+class Ephemerids(object):
+    '''
+    Moon and twilight ephemerids of a night.
+    The results are cached by (site, night, type of ephemerids),
+    in memory and in cache_directory/ephem, so each night is
+    only calculated once.
+    '''
+    memory_cache = cache.LRUCache(maxsize=64)
+
+    def __init__(self):
+        self.Observatory = define_ephem_observatory()
+        # The night also depends on the timezone (see end_of_the_day)
+        self.site = '%s_%+.0fm_UTC%+g' %(\
+         cache.site_key(config._observatory_latitude,config._observatory_longitude),\
+         config._observatory_altitude,config._local_timezone)
+
+    def ephem_date_to_datetime(self,ephem_date):
+        # Convert ephem dates to datetime (rounded to the second)
+        return(EPHEM_EPOCH+datetime.timedelta(\
+         seconds=int(round(float(ephem_date)*86400))))
+
+    def end_of_the_day(self,thedate):
+        newdate = thedate+datetime.timedelta(days=1)
+        newdatetime = datetime.datetime(\
+            newdate.year,\
+            newdate.month,\
+            newdate.day,0,0,0)
+        newdatetime = newdatetime-datetime.timedelta(hours=config._local_timezone)
+
+        return(newdatetime)
+
+    def load_ephems(self,kind,thedate,calculate):
+        '''
+        Set the ephemerids returned by calculate(thedate) as attributes,
+        using the cached ones if available.
+        '''
+        key = (self.site,str(thedate),kind)
+        ephems = self.memory_cache.get(key)
+        if ephems is None:
+            filename = os.path.join(cache.cache_directory('ephem',self.site),\
+             '%s_%s.json' %(kind,str(thedate).replace('-','')))
+            try:
+                stored = json.load(open(filename))
+            except (IOError,OSError,ValueError):
+                ephems = calculate(thedate)
+                # Dates are stored as seconds since EPHEM_EPOCH
+                stored = dict([(name,{'seconds':int((value-EPHEM_EPOCH).total_seconds())}) \
+                 if isinstance(value,datetime.datetime) else (name,value) \
+                 for name,value in ephems.items()])
+                cache.save_bytes(filename,json.dumps(stored).encode('utf-8'))
+            else:
+                ephems = dict([(str(name),EPHEM_EPOCH+datetime.timedelta(seconds=value['seconds'])) \
+                 if isinstance(value,dict) else (str(name),value) \
+                 for name,value in stored.items()])
+            self.memory_cache.put(key,ephems)
+
+        for name,value in ephems.items():
+            setattr(self,name,value)
+
+    def calculate_moon_ephems(self,thedate):
+        self.load_ephems('moon',thedate,self.compute_moon_ephems)
+
+    def compute_moon_ephems(self,thedate):
+        # Moon ephemerids
+        self.Observatory.horizon = '0'
+        self.Observatory.date = ephem.Date(self.end_of_the_day(thedate))
+
+        # Moon phase
+        Moon = ephem.Moon()
+        Moon.compute(self.Observatory)
+        moon_phase = Moon.phase
+        moon_maxelev = Moon.transit_alt
+
+        try:
+            float(moon_maxelev)
+        except:
+            # The moon has no culmination time for 1 day
+            # per month, so there is no max altitude.
+            # As a workaround, we use the previous day culmination.
+            # The error should be small.
+
+            # Set the previous day date
+            thedate2 = thedate - datetime.timedelta(days=1)
+            self.Observatory.date = ephem.Date(self.end_of_the_day(thedate2))
+            Moon2 = ephem.Moon()
+            Moon2.compute(self.Observatory)
+            moon_maxelev = Moon2.transit_alt
+
+            # Recover the real date
+            self.Observatory.date = ephem.Date(self.end_of_the_day(thedate))
+
+        # Moon rise and set
+        return({\
+         'moon_phase': float(moon_phase),\
+         'moon_maxelev': float(moon_maxelev),\
+         'moon_prev_rise': self.ephem_date_to_datetime(\
+            self.Observatory.previous_rising(ephem.Moon())),\
+         'moon_prev_set': self.ephem_date_to_datetime(\
+            self.Observatory.previous_setting(ephem.Moon())),\
+         'moon_next_rise': self.ephem_date_to_datetime(\
+            self.Observatory.next_rising(ephem.Moon())),\
+         'moon_next_set': self.ephem_date_to_datetime(\
+            self.Observatory.next_setting(ephem.Moon()))})
+
+    def moon_up_intervals(self):
+        '''
+        Periods of time (UTC) with the moon above the horizon
+        around the night of the last calculate_moon_ephems.
+        '''
+        if self.moon_next_rise > self.moon_next_set:
+            # The moon is up at midnight
+            return([(self.moon_prev_rise,self.moon_next_set)])
+        else:
+            return([(self.moon_prev_rise,self.moon_prev_set),\
+             (self.moon_next_rise,self.moon_next_set)])
+
+    def calculate_twilight(self,thedate,twilight=-18):
+        '''
+        Changing the horizon forces ephem to
+        calculate different types of twilights:
+        -6: civil,
+        -12: nautical,
+        -18: astronomical,
+        '''
+        self.load_ephems('twilight%+g' %twilight,thedate,\
+         lambda thedate: self.compute_twilight(thedate,twilight))
+
+    def compute_twilight(self,thedate,twilight=-18):
+        self.Observatory.horizon = str(twilight)
+        self.Observatory.date = ephem.Date(self.end_of_the_day(thedate))
+
+        return({\
+         'twilight_prev_rise': self.ephem_date_to_datetime(\
+            self.Observatory.previous_rising(ephem.Sun(),use_center=True)),\
+         'twilight_prev_set': self.ephem_date_to_datetime(\
+            self.Observatory.previous_setting(ephem.Sun(),use_center=True)),\
+         'twilight_next_rise': self.ephem_date_to_datetime(\
+            self.Observatory.next_rising(ephem.Sun(),use_center=True)),\
+         'twilight_next_set': self.ephem_date_to_datetime(\
+            self.Observatory.next_setting(ephem.Sun(),use_center=True))})
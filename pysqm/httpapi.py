@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+'''
+PySQM HTTP data server
+____________________________
+
+Copyright (c) Miguel Nievas <miguelnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Optional HTTP server (_api_port in the config) with the data of the
+photometer, so other programs dont have to parse the data files:
+
+ /latest                  Last record of the current night (JSON)
+ /night  /night.csv       Current night (JSON or CSV)
+ /data?from=T1&to=T2      Records of the daily files between two UTC
+                          times (YYYY-MM-DD[THH[:mm[:ss]]]). Add
+                          &format=csv for CSV.
+ /images                  List of the plots (JSON)
+ /images/<name>.png       Current and daily plots, heatmap
+
+The current file is followed with a SDFTail (only the new lines are
+parsed). The responses are kept in memory and reused while the files
+they come from (size, modification time) dont change. ETag and
+Last-Modified are sent, so clients can poll with If-None-Match /
+If-Modified-Since and get a 304 when there is nothing new.
+____________________________
+'''
+
+# email.utils is the standard module, not pysqm/email.py (python 2)
+from __future__ import absolute_import
+
+import os,sys
+import json
+import hashlib
+import threading
+import email.utils
+import numpy as np
+
+import pysqm.sdf as sdf
+import pysqm.cache as cache
+from pysqm.reprocess import find_files
+
+try:
+    import BaseHTTPServer as httpserver
+    import SocketServer as socketserver
+    from urlparse import urlparse,parse_qs
+except ImportError:
+    import http.server as httpserver
+    import socketserver
+    from urllib.parse import urlparse,parse_qs
+
+
+COLUMNS = ['utc_date','local_date','temperature','counts','frequency','msas']
+CSV_HEADER = '# UTC Date & Time, Local Date & Time, Temperature, Counts, Frequency, MSAS\n'
+CONTENT_TYPES = {'json':'application/json','csv':'text/csv; charset=utf-8',\
+ 'png':'image/png'}
+
+
+class RequestError(Exception):
+    def __init__(self,status,message):
+        Exception.__init__(self,message)
+        self.status = status
+
+
+def file_signature(filename):
+    # (name, size, modification time), or None if the file doesnt exist
+    try: stat = os.stat(filename)
+    except OSError: return(None)
+    return(filename,stat.st_size,stat.st_mtime)
+
+
+def records_table(Data):
+    ''' Rows of a SDFData as lists of values, in COLUMNS order '''
+    return([list(record) for record in zip(\
+     Data.utc_str.tolist(),Data.local_str.tolist(),\
+     Data.temperatures.tolist(),Data.tick_counts.tolist(),\
+     Data.frequencies.tolist(),Data.night_sbs.tolist())])
+
+
+def format_json(Data):
+    return(json.dumps({'columns':COLUMNS,'metadata':Data.metadata,\
+     'rows':records_table(Data)},separators=(',',':')))
+
+
+def format_csv(Data):
+    # Same format as the data lines written by the daemon
+    lines = [sdf.DATA_LINE_FORMAT %tuple(record) \
+     for record in records_table(Data)]
+    return(CSV_HEADER+''.join(lines))
+
+
+def parse_time(text,name):
+    try: value = sdf.parse_datetimes(np.array([text]))[0]
+    except (ValueError,TypeError): value = None
+    if value is None or value!=value:
+        # NaT
+        raise RequestError(400,'Invalid %s time: %s' %(name,text))
+    return(value)
+
+
+class DataServer(object):
+    '''
+    Build the responses of the API. Independent of the HTTP server,
+    so it can be used (and tested) directly.
+    '''
+    def __init__(self,config,cache_size=64):
+        self.config = config
+        self.current_datafile = \
+         config.current_data_directory+"/"+config._device_shorttype+\
+         "_"+config._observatory_name+".dat"
+        self.responses = cache.LRUCache(cache_size)
+        self.archive = cache.LRUCache(cache_size)
+        self.tail = sdf.SDFTail(self.current_datafile)
+        self.night = sdf.SDFData()
+        self.night_signature = None
+        self.tail_lock = threading.Lock()
+
+    def current_night(self):
+        ''' Data of the current file, reading only the new lines '''
+        with self.tail_lock:
+            signature = file_signature(self.current_datafile)
+            if signature is None:
+                self.tail.reset()
+                self.night = sdf.SDFData()
+            elif signature!=self.night_signature:
+                NewData = self.tail.read()
+                if self.tail.restarted: self.night = NewData
+                else: self.night.extend(NewData)
+                self.night.metadata = self.tail.metadata
+            self.night_signature = signature
+            return(self.night)
+
+    def load_daily_file(self,filename):
+        signature = file_signature(filename)
+        Data = self.archive.get(signature)
+        if Data is None:
+            Data = sdf.load_sdf(filename)
+            self.archive.put(signature,Data)
+        return(Data)
+
+    def archive_files(self,time_from,time_to):
+        # Observing nights (local time - 12 h) that can have data in the
+        # range, with one day of margin for the time zone.
+        date_from = (time_from-np.timedelta64(2,'D')).astype('datetime64[D]').item()
+        date_to = time_to.astype('datetime64[D]').item()
+        return(find_files([self.config.daily_data_directory],date_from,date_to))
+
+    def image_directories(self):
+        return([self.config.daily_graph_directory,\
+         self.config.summary_data_directory,self.config.current_graph_directory,\
+         self.config.current_data_directory])
+
+    def image_files(self):
+        ''' Dict name -> filename of the PNG plots '''
+        images = {}
+        for directory in self.image_directories():
+            try: names = os.listdir(directory)
+            except OSError: continue
+            for name in names:
+                if name.endswith('.png'):
+                    images[name] = os.path.join(directory,name)
+        return(images)
+
+    def sources(self,path,query):
+        '''
+        Files a response is made of. The cached response is valid
+        while their signatures dont change.
+        '''
+        if path in ['/latest','/night','/night.csv']:
+            return([self.current_datafile])
+        elif path=='/data':
+            if 'from' not in query or 'to' not in query:
+                raise RequestError(400,'from and to times are required')
+            time_from = parse_time(query['from'],'from')
+            time_to = parse_time(query['to'],'to')
+            if query.get('format','json') not in ['json','csv']:
+                raise RequestError(400,'Unknown format: '+query['format'])
+            return(self.archive_files(time_from,time_to))
+        elif path=='/images':
+            # A new plot changes the modification time of its directory
+            return(self.image_directories())
+        elif path.startswith('/images/'):
+            name = path[len('/images/'):]
+            filename = self.image_files().get(name)
+            if filename is None:
+                raise RequestError(404,'Image not found: '+name)
+            return([filename])
+        raise RequestError(404,'Unknown path: '+path)
+
+    def build(self,path,query):
+        ''' Return (kind, content) of a request '''
+        if path=='/latest':
+            Data = self.current_night()
+            if len(Data)==0:
+                raise RequestError(404,'No data in the current file')
+            record = dict(zip(COLUMNS,records_table(Data.select(slice(-1,None)))[0]))
+            return('json',json.dumps(record))
+        elif path=='/night':
+            return('json',format_json(self.current_night()))
+        elif path=='/night.csv':
+            return('csv',format_csv(self.current_night()))
+        elif path=='/data':
+            time_from = parse_time(query['from'],'from')
+            time_to = parse_time(query['to'],'to')
+            Data = sdf.SDFData()
+            for filename in self.archive_files(time_from,time_to):
+                FileData = self.load_daily_file(filename)
+                utcdates = sdf.parse_datetimes(FileData.utc_str)
+                rows = (utcdates>=time_from)*(utcdates<=time_to)
+                if np.any(rows):
+                    Data.extend(FileData.select(rows))
+            if query.get('format','json')=='csv':
+                return('csv',format_csv(Data))
+            return('json',format_json(Data))
+        elif path=='/images':
+            return('json',json.dumps(sorted(self.image_files().keys())))
+        else:
+            image = open(self.image_files()[path[len('/images/'):]],'rb')
+            content = image.read()
+            image.close()
+            return('png',content)
+
+    def response(self,path,query):
+        '''
+        Return (kind, content, etag, last modified timestamp),
+        from the memory cache if the sources didnt change.
+        '''
+        key = (path,tuple(sorted(query.items())))
+        signatures = tuple([file_signature(filename) \
+         for filename in self.sources(path,query)])
+        cached = self.responses.get(key)
+        if cached is not None and cached[0]==signatures:
+            return(cached[1])
+
+        kind,content = self.build(path,query)
+        if not isinstance(content,bytes): content = content.encode('utf-8')
+        etag = '"%s"' %hashlib.md5(repr((key,signatures)).encode('utf-8')).hexdigest()
+        last_modified = max([signature[2] for signature in signatures \
+         if signature is not None] or [0])
+        result = (kind,content,etag,last_modified)
+        self.responses.put(key,(signatures,result))
+        return(result)
+
+
+def not_modified(headers,etag,last_modified):
+    ''' Check the conditional headers of the request '''
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        return(etag in [tag.strip() for tag in if_none_match.split(',')] \
+         or if_none_match.strip()=='*')
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since is not None and last_modified:
+        since = email.utils.parsedate_tz(if_modified_since)
+        if since is not None:
+            return(int(last_modified)<=email.utils.mktime_tz(since))
+    return(False)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,httpserver.HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port,server,host='127.0.0.1'):
+    ''' Serve the DataServer on http://host:port/ '''
+
+    class APIHandler(httpserver.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = dict([(name,values[-1]) \
+             for name,values in parse_qs(url.query).items()])
+            path = url.path.rstrip('/') or '/'
+            try:
+                kind,content,etag,last_modified = server.response(path,query)
+            except RequestError as e:
+                return(self.send_content(e.status,'text/plain',str(e)+'\n'))
+            except Exception as e:
+                return(self.send_content(500,'text/plain',\
+                 'Internal error: '+str(e)+'\n'))
+
+            headers = [('ETag',etag),('Cache-Control','no-cache')]
+            if last_modified:
+                headers.append(('Last-Modified',\
+                 email.utils.formatdate(last_modified,usegmt=True)))
+            if not_modified(self.headers,etag,last_modified):
+                self.send_content(304,None,b'',headers)
+            else:
+                self.send_content(200,CONTENT_TYPES[kind],content,headers)
+
+        def send_content(self,status,content_type,content,headers=[]):
+            if not isinstance(content,bytes): content = content.encode('utf-8')
+            self.send_response(status)
+            if content_type is not None:
+                self.send_header('Content-Type',content_type)
+                self.send_header('Content-Length',str(len(content)))
+            for name,value in headers:
+                self.send_header(name,value)
+            self.end_headers()
+            if content: self.wfile.write(content)
+
+        def log_message(self,*args):
+            # Dont fill the screen with requests
+            pass
+
+    httpd = ThreadingHTTPServer((host,int(port)),APIHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return(httpd)
+
+
+_started = False
+
+def start(config):
+    '''
+    Start the server if _api_port is set in the config.
+    Nothing is started (and no thread created) otherwise.
+    '''
+    global _started
+    if _started: return
+    _started = True
+
+    try: config._api_port
+    except: config._api_port = None
+    try: config._api_host
+    except: config._api_host = '127.0.0.1'
+    try: config._api_cache_size
+    except: config._api_cache_size = 64
+
+    if config._api_port is not None:
+        try:
+            start_http_server(config._api_port,\
+             DataServer(config,config._api_cache_size),config._api_host)
+        except Exception as e:
+            print('Warning: cannot start the HTTP data server: '+str(e))
@@ -26,7 +26,9 @@ ____________________________
 import os,sys
 import time
 import datetime
-import argparse
+
+# Time reference to measure the startup time (restart to first sample)
+StartupTime = time.time()
 
 
 '''
@@ -43,38 +45,21 @@ settings.GlobalConfig.read_config_file(configfilename)
 config = settings.GlobalConfig.config
     
 ### Load now the rest of the modules
+# Only the device/sink modules selected in the config are imported by
+# pysqm.read. Plotting (matplotlib) is loaded on first use, see make_plot.
 from pysqm.read import *
-import pysqm.plot
-
-'''
-This import section is only for software build purposes.
-Dont worry if some of these are missing in your setup.
-'''
-
-def relaxed_import(themodule):
-    try: exec('import '+str(themodule))
-    except: pass
-
-relaxed_import('socket')
-relaxed_import('serial')
-relaxed_import('_mysql')
-relaxed_import('pysqm.email')
-
-
-'''
-Conditional imports
-'''
-
-# If the old format (SQM_LE/SQM_LU) is used, replace _ with -
-config._device_type = config._device_type.replace('_','-')
-
-if config._device_type == 'SQM-LE':
-    import socket
-elif config._device_type == 'SQM-LU':
-    import serial
-if config._use_mysql == True:
-    import _mysql
-
+import pysqm.metrics as metrics
+
+# Metrics, profiling and the other optional services of the config.
+# The time of these steps is measured by python -m pysqm.startup
+import pysqm.startup
+services = pysqm.startup.start_services(config)
+ring_writer = services['ring_writer']
+publisher = services['publisher']
+profiler = services['profiler']
+if ring_writer is not None or publisher is not None:
+    # Record format of the samples
+    import pysqm.ringbuffer
 
 # Create directories if needed
 for directory in [config.monthly_data_directory,config.daily_data_directory,config.current_data_directory]:
@@ -96,17 +81,74 @@ else:
     exit(0)
 
 
+def make_plot(send_emails=False,write_stats=False):
+    '''
+    Import the plotting module (and matplotlib) the first time
+    a plot is needed, not at daemon startup.
+    '''
+    import pysqm.plot
+    with metrics.timer('pysqm_plot_seconds','Time to make the plot'):
+        pysqm.plot.make_plot(send_emails=send_emails,write_stats=write_stats)
+
+
+def save_night_statistics(Accumulator):
+    ''' Write the statistics of the night from the accumulator '''
+    import pysqm.plot
+    with metrics.timer('pysqm_statistics_seconds','Time to write the night statistics'):
+        pysqm.plot.save_night_statistics(Accumulator)
+
+
+def night_accumulator(night,timeutc):
+    '''
+    Statistics accumulator for a new night (see statistics.NightAccumulator).
+    If the daemon was restarted during the night, the samples already
+    saved in the daily file (before timeutc) are added first; flush the
+    data cache before calling it.
+    '''
+    import numpy as np
+    import pysqm.statistics as statistics
+    from pysqm.ephemerids import Ephemerids
+    Ephem = Ephemerids()
+    Ephem.calculate_twilight(thedate=night)
+    Accumulator = statistics.NightAccumulator(night,\
+     (Ephem.twilight_prev_set,Ephem.twilight_next_rise))
+
+    if os.path.exists(mydevice.daily_datafile):
+        import pysqm.sdf as sdf
+        Data = sdf.load_sdf(mydevice.daily_datafile)
+        utcdates = sdf.parse_datetimes(Data.utc_str)
+        localdates = sdf.parse_datetimes(Data.local_str)
+        # Same rows and values as the plot (see SQMData.process_rawdata)
+        timezone = np.timedelta64(int(round(config._local_timezone*3600)),'s')
+        valid = ((localdates-utcdates)==timezone)*(utcdates<np.datetime64(timeutc,'s'))
+        for values in zip(utcdates[valid],localdates[valid],\
+         corrected_sky_brightness(Data.night_sbs[valid]),Data.temperatures[valid]):
+            Accumulator.add(*values)
+    return(Accumulator)
+
+
+def corrected_sky_brightness(sky_brightness):
+    # Offset applied to the plot and statistics (_plot_corrected_data)
+    if getattr(config,'_plot_corrected_data',False):
+        return(sky_brightness+config._offset_calibration)
+    return(sky_brightness)
+
+
 def loop():
     '''
     Ephem is used to calculate moon position (if above horizon)
     and to determine start-end times of the measures
     '''
+    global StartupTime
     observ = define_ephem_observatory()
     niter = 0
+    ExpectedDateTime = None
     DaytimePrint=True
+    Accumulator = None
     print('Starting readings ...')
     while 1<2:
         ''' The programs works as a daemon '''
+        if profiler is not None: profiler.poll()
         utcdt = mydevice.read_datetime()
         #print (str(mydevice.local_datetime(utcdt))),
         if mydevice.is_nighttime(observ):
@@ -121,6 +163,12 @@ def loop():
             StartDateTime = datetime.datetime.now()
             niter += 1
 
+            # How late is this iteration with respect to the expected time
+            if ExpectedDateTime is not None:
+                metrics.histogram('pysqm_loop_lateness_seconds',\
+                 'Delay of the loop iterations over the expected time').observe(\
+                 max(0,(StartDateTime-ExpectedDateTime).total_seconds()))
+
             mydevice.define_filenames()
 
             ''' Get values from the photometer '''
@@ -131,6 +179,8 @@ def loop():
                      Nmeasures=config._measures_to_promediate,PauseMeasures=10)
             except:
                 print('Connection lost')
+                metrics.counter('pysqm_connection_lost_total',\
+                 'Number of failed readings of the photometer').inc()
                 if config._reboot_on_connlost == True:
                     sleep(600)
                     os.system('reboot.bat')
@@ -142,33 +192,84 @@ def loop():
                 timeutc_mean,timelocal_mean,temp_sensor,\
                 freq_sensor,ticks_uC,sky_brightness)
 
+            metrics.counter('pysqm_samples_total','Number of samples taken').inc()
+            metrics.gauge('pysqm_sky_brightness','Last sky brightness (mag/arcsec2)').set(sky_brightness)
+            metrics.gauge('pysqm_temperature','Last sensor temperature (C)').set(temp_sensor)
+
             try:
                 assert(config._use_mysql == True)
-                mydevice.save_data_mysql(formatted_data)
+                with metrics.timer('pysqm_sink_seconds','Time spent in each data sink',sink='mysql'):
+                    mydevice.save_data_mysql(formatted_data)
             except: pass
 
             try:
                 assert(config._send_to_datacenter == True)
-                mydevice.save_data_datacenter(formatted_data)
+                with metrics.timer('pysqm_sink_seconds','Time spent in each data sink',sink='datacenter'):
+                    mydevice.save_data_datacenter(formatted_data)
             except: pass
 
-            mydevice.data_cache(formatted_data,number_measures=config._cache_measures,niter=niter)
+            with metrics.timer('pysqm_sink_seconds','Time spent in each data sink',sink='files'):
+                mydevice.data_cache(formatted_data,number_measures=config._cache_measures,niter=niter)
+
+            if ring_writer is not None or publisher is not None:
+                record = pysqm.ringbuffer.sample_record(\
+                 timeutc_mean,timelocal_mean,temp_sensor,\
+                 ticks_uC,freq_sensor,sky_brightness)
+                if ring_writer is not None:
+                    ring_writer.append(record)
+                if publisher is not None:
+                    with metrics.timer('pysqm_sink_seconds','Time spent in each data sink',sink='publish'):
+                        publisher.publish(record)
+
+            if StartupTime is not None:
+                print('Startup time (restart to first sample): %.2f s' \
+                    %(time.time()-StartupTime))
+                metrics.gauge('pysqm_startup_seconds',\
+                 'Time from (re)start to the first sample').set(time.time()-StartupTime)
+                StartupTime = None
+
+            # Statistics of the night, updated with each sample.
+            # Same values as in the data file.
+            night = (timelocal_mean-datetime.timedelta(hours=12)).date()
+            try:
+                if Accumulator is None or Accumulator.night!=night:
+                    # The samples still in the cache (loop restarted during
+                    # the night) must be in the daily file to be added.
+                    mydevice.flush_cache()
+                    Accumulator = night_accumulator(night,timeutc_mean)
+                fields = formatted_data.split(';')
+                Accumulator.add(timeutc_mean,timelocal_mean,\
+                 corrected_sky_brightness(float(fields[5])),float(fields[2]))
+                metrics.gauge('pysqm_night_median_sky_brightness',\
+                 'Running median of the night sky brightness (mag/arcsec2)').set(\
+                 Accumulator.median)
+            except:
+                print('Warning: Error updating the night statistics.')
+                print(sys.exc_info())
+                Accumulator = None
 
             if niter%config._plot_each == 0:
                 ''' Each X minutes, plot a new graph '''
-                try: pysqm.plot.make_plot(send_emails=False,write_stats=False)
+                try: make_plot(send_emails=False,write_stats=False)
                 except:
                     print('Warning: Error plotting data.')
                     print(sys.exc_info())
+                    metrics.counter('pysqm_plot_errors_total','Number of failed plots').inc()
 
             if DaytimePrint==False:
                 DaytimePrint=True
 
             MainDeltaSeconds = (datetime.datetime.now()-StartDateTime).total_seconds()
-            time.sleep(max(1,config._delay_between_measures-MainDeltaSeconds))
+            SleepSeconds = max(1,config._delay_between_measures-MainDeltaSeconds)
+            ExpectedDateTime = StartDateTime+\
+             datetime.timedelta(seconds=MainDeltaSeconds+SleepSeconds)
+            time.sleep(SleepSeconds)
 
         else:
             ''' Daytime, print info '''
+            # Startup time is only meaningful if the first sample is taken right away
+            StartupTime = None
+            ExpectedDateTime = None
             if DaytimePrint==True:
                 utcdt = utcdt.strftime("%Y-%m-%d %H:%M:%S")
                 print (utcdt),
@@ -176,14 +277,27 @@ def loop():
                 DaytimePrint=False
             if niter>0:
                 mydevice.flush_cache()
+
+                # Statistics ready from the acquisition. If not available,
+                # make_plot computes them from the data file.
+                write_stats = True
+                if Accumulator is not None:
+                    try:
+                        save_night_statistics(Accumulator)
+                        write_stats = False
+                    except:
+                        print('Warning: Error writing the night statistics.')
+                        print(sys.exc_info())
+                    Accumulator = None
+
                 if config._send_data_by_email==True:
-                    try: pysqm.plot.make_plot(send_emails=True,write_stats=True)
+                    try: make_plot(send_emails=True,write_stats=write_stats)
                     except:
                         print('Warning: Error plotting data / sending email.')
                         print(sys.exc_info())
 
                 else:
-                    try: pysqm.plot.make_plot(send_emails=False,write_stats=True)
+                    try: make_plot(send_emails=False,write_stats=write_stats)
                     except:
                         print('Warning: Error plotting data.')
                         print(sys.exc_info())
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+'''
+PySQM runtime metrics
+____________________________
+
+Copyright (c) Miguel Nievas <miguelnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Counters, gauges and latency histograms for the acquisition daemon.
+The values are always recorded (it is cheap). They are only exported
+if the config asks for it:
+ - _metrics_file: file rewritten each _metrics_interval seconds.
+ - _metrics_port: local HTTP endpoint (Prometheus text format).
+____________________________
+'''
+
+import os,sys
+import time
+import threading
+
+from pysqm.cache import write_file
+
+DEFAULT_BUCKETS = (0.001,0.005,0.01,0.05,0.1,0.5,1.,2.5,5.,10.,30.,60.)
+
+
+def format_labels(labels):
+    # {"sink":"mysql"} -> '{sink="mysql"}'
+    if not labels:
+        return('')
+    return('{'+','.join(['%s="%s"' %(k,v) for k,v in labels])+'}')
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0.
+
+    def inc(self,amount=1):
+        self.value += amount
+
+    def samples(self,name,labels):
+        return([(name+format_labels(labels),self.value)])
+
+
+class Gauge(object):
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0.
+
+    def set(self,value):
+        self.value = float(value)
+
+    def samples(self,name,labels):
+        return([(name+format_labels(labels),self.value)])
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self,buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts  = [0]*len(self.buckets)
+        self.count   = 0
+        self.sum     = 0.
+
+    def observe(self,value):
+        for k,upper in enumerate(self.buckets):
+            if value<=upper:
+                self.counts[k] += 1
+                break
+        self.count += 1
+        self.sum   += value
+
+    def samples(self,name,labels):
+        # Prometheus buckets are cumulative
+        samples = []
+        cumulative = 0
+        for upper,count in zip(self.buckets,self.counts):
+            cumulative += count
+            samples.append((name+'_bucket'+\
+             format_labels(list(labels)+[('le',repr(float(upper)))]),cumulative))
+        samples.append((name+'_bucket'+\
+         format_labels(list(labels)+[('le','+Inf')]),self.count))
+        samples.append((name+'_sum'+format_labels(labels),self.sum))
+        samples.append((name+'_count'+format_labels(labels),self.count))
+        return(samples)
+
+
+class Timer(object):
+    ''' Context manager, observes the elapsed seconds in a histogram '''
+    def __init__(self,histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return(self)
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.histogram.observe(time.time()-self.start)
+        return(False)
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.descriptions = {}
+
+    def get(self,kind,name,description,labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            try:
+                return(self.metrics[(name,labels)])
+            except KeyError:
+                metric = kind()
+                self.metrics[(name,labels)] = metric
+                self.descriptions[name] = (description,metric.kind)
+                return(metric)
+
+    def counter(self,name,description='',**labels):
+        return(self.get(Counter,name,description,labels))
+
+    def gauge(self,name,description='',**labels):
+        return(self.get(Gauge,name,description,labels))
+
+    def histogram(self,name,description='',**labels):
+        return(self.get(Histogram,name,description,labels))
+
+    def timer(self,name,description='',**labels):
+        return(Timer(self.histogram(name,description,**labels)))
+
+    def prometheus_text(self):
+        ''' Export all the metrics in the Prometheus text format '''
+        lines = []
+        with self.lock:
+            for name in sorted(self.descriptions):
+                description,kind = self.descriptions[name]
+                lines.append('# HELP %s %s' %(name,description))
+                lines.append('# TYPE %s %s' %(name,kind))
+                for (mname,labels),metric in sorted(self.metrics.items()):
+                    if mname!=name: continue
+                    for sample,value in metric.samples(name,labels):
+                        lines.append('%s %s' %(sample,repr(float(value))))
+        return('\n'.join(lines)+'\n')
+
+
+# Registry used by the whole program
+REGISTRY = Registry()
+
+counter   = REGISTRY.counter
+gauge     = REGISTRY.gauge
+histogram = REGISTRY.histogram
+timer     = REGISTRY.timer
+
+
+def write_stats_file(filename,registry=REGISTRY):
+    # Write to a temp file and rename, readers never see a partial file
+    text = registry.prometheus_text()
+    write_file(filename,lambda thefile: thefile.write(text),'w')
+
+
+def stats_file_writer(filename,interval,registry=REGISTRY):
+    while True:
+        try: write_stats_file(filename,registry)
+        except Exception as e:
+            print('Warning: cannot write the metrics file: '+str(e))
+        time.sleep(interval)
+
+
+def start_http_server(port,registry=REGISTRY,host='127.0.0.1'):
+    ''' Serve the metrics on http://host:port/metrics '''
+    try:
+        import BaseHTTPServer as httpserver
+    except ImportError:
+        import http.server as httpserver
+
+    class MetricsHandler(httpserver.BaseHTTPRequestHandler):
+        def do_GET(self):
+            content = registry.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type','text/plain; version=0.0.4')
+            self.send_header('Content-Length',str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self,*args):
+            # Dont fill the screen with requests
+            pass
+
+    server = httpserver.HTTPServer((host,int(port)),MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return(server)
+
+
+_started = False
+
+def start(config):
+    '''
+    Start the exporters requested in the config.
+    Nothing is started (and no thread created) if none is configured.
+    '''
+    global _started
+    if _started: return
+    _started = True
+
+    try: config._metrics_file
+    except: config._metrics_file = None
+    try: config._metrics_port
+    except: config._metrics_port = None
+    try: config._metrics_interval
+    except: config._metrics_interval = 60
+
+    if config._metrics_file is not None:
+        thread = threading.Thread(target=stats_file_writer,\
+         args=(config._metrics_file,config._metrics_interval))
+        thread.daemon = True
+        thread.start()
+
+    if config._metrics_port is not None:
+        try: start_http_server(config._metrics_port)
+        except Exception as e:
+            print('Warning: cannot start the metrics server: '+str(e))
@@ -24,7 +24,10 @@ ____________________________
 '''
 
 import os,sys
-import ephem
+import io
+import copy
+import json
+import hashlib
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
@@ -34,6 +37,11 @@ import matplotlib.dates as mdates
 from datetime import datetime,date,timedelta
 
 from pysqm.common import *
+import pysqm.sdf as sdf
+import pysqm.astro as astro
+import pysqm.cache as cache
+import pysqm.statistics as statistics
+from pysqm.ephemerids import Ephemerids
 
 
 '''
@@ -43,376 +51,384 @@ import pysqm.settings as settings
 config = settings.GlobalConfig.config
 
 
-for directory in [config.monthly_data_directory,config.daily_graph_directory,config.current_graph_directory]:
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+def create_directories():
+    ''' Create the plot directories (if needed) '''
+    for directory in [config.monthly_data_directory,config.daily_graph_directory,config.current_graph_directory]:
+        cache.make_directory(directory)
 
 
-class Ephemerids(object):
-    def __init__(self):
-        self.Observatory = define_ephem_observatory()
+# Sun altitude lookup tables of the observatory, shared by all the plots
+_sun_altitude_table = None
 
-    def ephem_date_to_datetime(self,ephem_date):
-        # Convert ephem dates to datetime
-        date_,time_ = str(ephem_date).split(' ')
-        date_ = date_.split('/')
-        time_ = time_.split(':')
+def sun_altitude_table():
+    global _sun_altitude_table
+    if _sun_altitude_table is None:
+        _sun_altitude_table = astro.SunAltitudeTable(\
+         config._observatory_latitude,config._observatory_longitude,\
+         directory=cache.cache_directory('sunalt',cache.site_key(\
+          config._observatory_latitude,config._observatory_longitude)))
+    return(_sun_altitude_table)
 
-        return(datetime.datetime(\
-            int(date_[0]),int(date_[1]),int(date_[2]),\
-            int(time_[0]),int(time_[1]),int(time_[2])))
 
-    def end_of_the_day(self,thedate):
-        newdate = thedate+datetime.timedelta(days=1)
-        newdatetime = datetime.datetime(\
-            newdate.year,\
-            newdate.month,\
-            newdate.day,0,0,0)
-        newdatetime = newdatetime-datetime.timedelta(hours=config._local_timezone)
+def downsample_minmax(xdata,ydata,width):
+    '''
+    Reduce a line to what can be seen with width pixel columns:
+    for each column keep the first, last, min and max points (M4).
+    The points are kept in their original order.
+    Return the downsampled xdata, ydata.
+    '''
+    xdata = np.asarray(xdata)
+    ydata = np.asarray(ydata)
+    if np.size(ydata)<=4*width:
+        return(xdata,ydata)
+
+    xvalues = xdata
+    if xvalues.dtype.kind=='M':
+        xvalues = xvalues.astype('datetime64[s]').astype(np.int64)
+    elif xvalues.dtype==object:
+        xvalues = mdates.date2num(xvalues)
+    xvalues = np.asarray(xvalues,dtype=float)
+
+    # Runs of consecutive points in the same pixel column
+    xrange = np.max(xvalues)-np.min(xvalues)
+    if xrange==0: xrange = 1.
+    column = ((xvalues-np.min(xvalues))*(width/xrange)).astype(int)
+    starts = np.concatenate([[0],np.flatnonzero(np.diff(column))+1])
+    ends = np.concatenate([starts[1:],[np.size(column)]])-1
+    run = np.repeat(np.arange(np.size(starts)),ends-starts+1)
+
+    # First min and max of each run
+    keep = [starts,ends]
+    for reduction in [np.minimum,np.maximum]:
+        extreme = np.flatnonzero(ydata==reduction.reduceat(ydata,starts)[run])
+        keep.append(extreme[np.unique(run[extreme],return_index=True)[1]])
+
+    keep = np.unique(np.concatenate(keep))
+    return(xdata[keep],ydata[keep])
+
+
+# One row of processed data
+SQM_DTYPE = np.dtype([\
+ ('utcdate','datetime64[s]'),('localdate','datetime64[s]'),\
+ ('temperature',float),('tick_counts',float),('frequency',float),\
+ ('night_sb',float),('sun_altitude',float)])
+
+
+class SQMNightPart(object):
+    '''
+    Pre or after-midnight part of a night: the rows of the
+    night data where mask is True. Columns are given as arrays,
+    dates as datetime objects.
+    '''
+    def __init__(self,data,mask):
+        self.data = data
+        self.mask = mask
 
-        return(newdatetime)
+    def column(self,name):
+        return(self.data[name][self.mask])
 
+    utcdates     = property(lambda self: self.column('utcdate').astype(datetime.datetime))
+    localdates   = property(lambda self: self.column('localdate').astype(datetime.datetime))
+    temperatures = property(lambda self: self.column('temperature'))
+    tick_counts  = property(lambda self: self.column('tick_counts'))
+    frequencies  = property(lambda self: self.column('frequency'))
+    night_sbs    = property(lambda self: self.column('night_sb'))
+    sun_altitude = property(lambda self: self.column('sun_altitude'))
 
-    def calculate_moon_ephems(self,thedate):
-        # Moon ephemerids
-        self.Observatory.horizon = '0'
-        self.Observatory.date = str(self.end_of_the_day(thedate))
+    @property
+    def label_dates(self):
+        # Dates in str format: 20130115
+        return([str(label_date).replace('-','') for label_date in \
+         np.unique(self.column('localdate').astype('datetime64[D]'))])
 
-        # Moon phase
-        Moon = ephem.Moon()
-        Moon.compute(self.Observatory)
-        self.moon_phase = Moon.phase
-        self.moon_maxelev = Moon.transit_alt
-
-        try:
-            float(self.moon_maxelev)
-        except:
-            # The moon has no culmination time for 1 day
-            # per month, so there is no max altitude.
-            # As a workaround, we use the previous day culmination.
-            # The error should be small.
-
-            # Set the previous day date
-            thedate2 = thedate - datetime.timedelta(days=1)
-            self.Observatory.date = str(self.end_of_the_day(thedate2))
-            Moon2 = ephem.Moon()
-            Moon2.compute(self.Observatory)
-            self.moon_maxelev = Moon2.transit_alt
-
-            # Recover the real date
-            self.Observatory.date = str(self.end_of_the_day(thedate))
-
-        # Moon rise and set
-        self.moon_prev_rise = \
-         self.ephem_date_to_datetime(self.Observatory.previous_rising(ephem.Moon()))
-        self.moon_prev_set  = \
-         self.ephem_date_to_datetime(self.Observatory.previous_setting(ephem.Moon()))
-        self.moon_next_rise = \
-         self.ephem_date_to_datetime(self.Observatory.next_rising(ephem.Moon()))
-        self.moon_next_set  = \
-         self.ephem_date_to_datetime(self.Observatory.next_setting(ephem.Moon()))
-
-    def calculate_twilight(self,thedate,twilight=-18):
-        '''
-        Changing the horizon forces ephem to
-        calculate different types of twilights:
-        -6: civil,
-        -12: nautical,
-        -18: astronomical,
-        '''
-        self.Observatory.horizon = str(twilight)
-        self.Observatory.date = str(self.end_of_the_day(thedate))
-
-        self.twilight_prev_rise = self.ephem_date_to_datetime(\
-         self.Observatory.previous_rising(ephem.Sun(),use_center=True))
-        self.twilight_prev_set = self.ephem_date_to_datetime(\
-         self.Observatory.previous_setting(ephem.Sun(),use_center=True))
-        self.twilight_next_rise = self.ephem_date_to_datetime(\
-         self.Observatory.next_rising(ephem.Sun(),use_center=True))
-        self.twilight_next_set = self.ephem_date_to_datetime(\
-         self.Observatory.next_setting(ephem.Sun(),use_center=True))
 
+class NightStatistics(object):
+    # Summary statistics of a night (see SQMData.data_statistics)
+    def update(self,stats):
+        # Set the fields of a statistics.NIGHT_STATS_DTYPE row
+        for name in stats.dtype.names:
+            if name!='night':
+                setattr(self,name,stats[name])
 
 
 class SQMData(object):
     # Split pre and after-midnight data
 
-    class premidnight(object):
-        pass
-
-    class aftermidnight(object):
-        pass
-
-    class Statistics(object):
-        pass
-
     def __init__(self,filename,Ephem):
-        self.all_night_sb = []
-        self.all_night_dt = []
-        self.all_night_temp = []
-
-        for variable in [\
-         'utcdates','localdates','sun_altitudes',\
-         'temperatures','tick_counts','frequencies',\
-         'night_sbs','label_dates','sun_altitude']:
-            setattr(self.premidnight,variable,[])
-            setattr(self.aftermidnight,variable,[])
-
-        self.load_rawdata(filename)
+        self.filename = filename
+        self.tail = sdf.SDFTail(filename)
+        self.reset()
+        self.update(Ephem)
+
+    def reset(self):
+        # Valid rows of the file, all the nights
+        self.data = np.empty(0,dtype=SQM_DTYPE)
+        self.nights = []
+        self.Night = None
+        self.night_data = self.data
+        self.premidnight = SQMNightPart(self.data,np.zeros(0,dtype=bool))
+        self.aftermidnight = SQMNightPart(self.data,np.zeros(0,dtype=bool))
+        self.Statistics = NightStatistics()
+
+    def update(self,Ephem):
+        '''
+        Process the lines appended to the file since the last call.
+        If the file was truncated or replaced, start again.
+        '''
+        self.load_rawdata(self.filename)
+        if self.tail.restarted:
+            self.reset()
         self.process_rawdata(Ephem)
         self.check_number_of_nights()
 
-    def extract_metadata(self,raw_data_and_metadata):
-        metadata_lines = [\
-         line for line in raw_data_and_metadata \
-         if format_value(line)[0]=='#']
-
+    def extract_metadata(self,metadata):
         # Extract the serial number
-        serial_number_line = [\
-         line for line in metadata_lines \
-         if 'SQM serial number:' in line][0]
-        self.serial_number = format_value(serial_number_line.split(':')[-1])
-
-    def check_validdata(self,data_line):
-        try:
-            assert(format_value(data_line)[0]!='#')
-            assert(format_value(data_line)[0]!='')
-        except:
-            return(False)
-        else:
-            return(True)
+        self.serial_number = format_value(metadata.get('SQM serial number',''))
+        return(metadata)
 
     def load_rawdata(self,filename):
         '''
-        Open the file, read the data and close the file
+        Read the new lines of the file in numpy column arrays
         '''
-        sqm_file = open(filename, 'r')
-        raw_data_and_metadata = sqm_file.readlines()
-        self.metadata = self.extract_metadata(raw_data_and_metadata)
+        self.raw_data = self.tail.read()
+        self.metadata = self.extract_metadata(self.raw_data.metadata)
 
-        self.raw_data = [\
-         line for line in raw_data_and_metadata \
-         if self.check_validdata(line)==True]
-        sqm_file.close()
-
-    def process_datetimes(self,str_datetime):
+    def process_datetimes(self,RawData):
         '''
-        Get date and time in a str format
-        Return as datetime object
+        Parse the UTC and local date strings to datetime64 arrays
+        and check that they are consistent with the local timezone.
+        Return the arrays and the filter of valid rows.
         '''
-        str_date,str_time = str_datetime.split('T')
-
-        year  = int(str_date.split('-')[0])
-        month = int(str_date.split('-')[1])
-        day   = int(str_date.split('-')[2])
+        utcdates   = sdf.parse_datetimes(RawData.utc_str)
+        localdates = sdf.parse_datetimes(RawData.local_str)
 
-        # Time may be not complete. Workaround
-        hour   = int(str_time.split(':')[0])
-        try:
-            minute = int(str_time.split(':')[1])
-        except:
-            minute = 0
-            second = 0
-        else:
-            try:
-                second = int(str_time.split(':')[2])
-            except:
-                second = 0
+        timezone = np.timedelta64(int(round(config._local_timezone*3600)),'s')
+        valid = (localdates-utcdates)==timezone
+        if not np.all(valid):
+            print('Warning, %d lines with local time inconsistent with the timezone' \
+             %np.sum(~valid))
 
-        return(datetime.datetime(year,month,day,hour,minute,second))
+        return(utcdates,localdates,valid)
 
     def process_rawdata(self,Ephem):
         '''
         Get the important information from the raw_data
         and put it in a more useful format
         '''
-        self.raw_data = format_value_list(self.raw_data)
-
-        for k,line in enumerate(self.raw_data):
-            # DateTime extraction
-            utcdatetime = self.process_datetimes(line[0])
-            localdatetime = self.process_datetimes(line[1])
-
-            # Check that datetimes are corrent
-            calc_localdatetime = utcdatetime+timedelta(hours=config._local_timezone)
-            if (calc_localdatetime != localdatetime): return 1
-
-            # Set the datetime for astronomical calculations.
-            Ephem.Observatory.date = ephem.date(utcdatetime)
-
-            # Date in str format: 20130115
-            label_date = str(localdatetime.date()).replace('-','')
-
-            # Temperature
-            temperature = float(line[2])
-            # Counts
-            tick_counts = float(line[3])
-            # Frequency
-            frequency   = float(line[4])
-            # Night sky background
-            night_sb    = float(line[5])
-            try: config._plot_corrected_nsb
-            except NameError: config._plot_corrected_nsb=False
-            if (config._plot_corrected_nsb):
-                night_sb += _plot_corrected_nsb*_offset_calibration
-            # Define sun in pyephem
-            Sun = ephem.Sun(Ephem.Observatory)
-
-            self.premidnight.label_date=[]
-            self.aftermidnight.label_dates=[]
-
-
-            if localdatetime.hour > 12:
-                self.premidnight.utcdates.append(utcdatetime)
-                self.premidnight.localdates.append(localdatetime)
-                self.premidnight.temperatures.append(temperature)
-                self.premidnight.tick_counts.append(tick_counts)
-                self.premidnight.frequencies.append(frequency)
-                self.premidnight.night_sbs.append(night_sb)
-                self.premidnight.sun_altitude.append(Sun.alt)
-                if label_date not in self.premidnight.label_dates:
-                    self.premidnight.label_dates.append(label_date)
-            else:
-                self.aftermidnight.utcdates.append(utcdatetime)
-                self.aftermidnight.localdates.append(localdatetime)
-                self.aftermidnight.temperatures.append(temperature)
-                self.aftermidnight.tick_counts.append(tick_counts)
-                self.aftermidnight.frequencies.append(frequency)
-                self.aftermidnight.night_sbs.append(night_sb)
-                self.aftermidnight.sun_altitude.append(Sun.alt)
-                if label_date not in self.aftermidnight.label_dates:
-                    self.aftermidnight.label_dates.append(label_date)
-
-            # Data for the complete night
-            self.all_night_dt.append(utcdatetime) # Must be in UTC!
-            self.all_night_sb.append(night_sb)
-            self.all_night_temp.append(temperature)
+        RawData = self.raw_data
+
+        # Night sky background, corrected from the offset if requested
+        try: config._plot_corrected_data
+        except: config._plot_corrected_data = False
+        night_sbs = RawData.night_sbs
+        if (config._plot_corrected_data):
+            night_sbs = night_sbs+config._offset_calibration
+
+        # DateTime extraction, only for lines with correct datetimes.
+        utcdates,localdates,valid = self.process_datetimes(RawData)
+
+        new_data = np.empty(np.sum(valid),dtype=SQM_DTYPE)
+        new_data['utcdate']     = utcdates[valid]
+        new_data['localdate']   = localdates[valid]
+        new_data['temperature'] = RawData.temperatures[valid]
+        new_data['tick_counts'] = RawData.tick_counts[valid]
+        new_data['frequency']   = RawData.frequencies[valid]
+        new_data['night_sb']    = night_sbs[valid]
+        # Sun altitude for all the data at once (interpolated)
+        new_data['sun_altitude'] = sun_altitude_table().altitude(utcdates[valid])
 
+        self.data = np.concatenate([self.data,new_data])
+
+        # Observing night of each row
+        self.nights = sdf.split_nights(self.data['localdate'])
 
     def check_number_of_nights(self):
         '''
         Check that the number of nights is exactly 1 and
-        extract it to a new variable self.Night.
+        select it (self.Night).
         Needed for the statistics part of the analysis and
-        to make the plot.
+        to make the plot. Files with several nights can
+        be processed night by night with select_night.
         '''
 
-        if np.size(self.premidnight.localdates)>0:
-            self.Night = np.unique([DT.date() \
-             for DT in self.premidnight.localdates])[0]
-        elif np.size(self.aftermidnight.localdates)>0:
-            self.Night = np.unique([(DT-datetime.timedelta(hours=12)).date() \
-             for DT in self.aftermidnight.localdates])[0]
-        else:
+        if len(self.nights)==0:
             print('Warning, No Night detected.')
             self.Night = None
+            return
+
+        if len(self.nights)>1:
+            print('Warning, %d nights in the data file.' %len(self.nights))
+        self.select_night(self.nights[0][0])
+
+    def select_night(self,night):
+        '''
+        Set the data of the given night (self.Night) and split
+        it in pre and after-midnight.
+        New objects are created, the ones of the previous
+        night are not modified.
+        '''
+        self.Night = night
+        self.night_data = self.data[dict(self.nights)[night]]
+
+        localdates = self.night_data['localdate']
+        hours = (localdates-localdates.astype('datetime64[D]'))\
+         .astype('timedelta64[h]').astype(int)
+        premidnight_mask = hours>12
+
+        self.premidnight = SQMNightPart(self.night_data,premidnight_mask)
+        self.aftermidnight = SQMNightPart(self.night_data,~premidnight_mask)
+        self.Statistics = NightStatistics()
+
+    # Data for the complete night
+    all_night_dt   = property(lambda self: \
+     self.night_data['utcdate'].astype(datetime.datetime)) # Must be in UTC!
+    all_night_sb   = property(lambda self: self.night_data['night_sb'])
+    all_night_temp = property(lambda self: self.night_data['temperature'])
 
     def data_statistics(self,Ephem):
         '''
-        Make statistics on the data.
+        Make statistics on the data of the selected night.
         Useful to summarize night conditions.
         '''
-        def select_bests(values,number):
-            return(np.sort(values)[::-1][0:number])
+        stats = statistics.night_statistics([(self.Night,slice(None))],\
+         self.night_data['night_sb'],self.night_data['temperature'],\
+         self.night_data['utcdate'],\
+         [(Ephem.twilight_prev_set,Ephem.twilight_next_rise)])[0]
 
-        def fourier_filter(array,nterms):
-            '''
-            Make a fourier filter for the first nterms terms.
-            '''
-            array_fft = np.fft.fft(array)
-            # Filter data
-            array_fft[nterms:]=0
-            filtered_array = np.fft.ifft(array_fft)
-            return(filtered_array)
-
-        astronomical_night_filter = (\
-         (np.array(self.all_night_dt)>Ephem.twilight_prev_set)*\
-         (np.array(self.all_night_dt)<Ephem.twilight_next_rise))
-
-        if np.sum(astronomical_night_filter)>10:
-            self.astronomical_night_sb = \
-                 np.array(self.all_night_sb)[astronomical_night_filter]
-            self.astronomical_night_temp = \
-                 np.array(self.all_night_temp)[astronomical_night_filter]
-        else:
+        if not stats['astronomical']:
             print(\
              'Warning, < 10 points in astronomical night, '+\
              ' using the whole night data instead')
-            self.astronomical_night_sb = self.all_night_sb
-            self.astronomical_night_temp = self.all_night_temp
-
-        Stat = self.Statistics
-        #with self.Statistics as Stat:
-        # Complete list
-        Stat.mean   = np.mean(self.astronomical_night_sb)
-        Stat.median = np.median(self.astronomical_night_sb)
-        Stat.std    = np.median(self.astronomical_night_sb)
-        Stat.number = np.size(self.astronomical_night_sb)
-        # Only the best 1/100th.
-        Stat.bests_number = int(1+Stat.number/50.)
-        Stat.bests_mean   = np.mean(select_bests(self.astronomical_night_sb,Stat.bests_number))
-        Stat.bests_median = np.median(select_bests(self.astronomical_night_sb,Stat.bests_number))
-        Stat.bests_std    = np.std(select_bests(self.astronomical_night_sb,Stat.bests_number))
-        Stat.bests_err    = Stat.bests_std*1./np.sqrt(Stat.bests_number)
-
-        Stat.model_nterm = Stat.bests_number
-        data_smooth = fourier_filter(self.astronomical_night_sb,nterms=Stat.model_nterm)
-        data_residuals = self.astronomical_night_sb-data_smooth
-        Stat.data_model_abs_meandiff = np.mean(np.abs(data_residuals))
-
-        # Other interesting data
-        Stat.min_temperature = np.min(self.astronomical_night_temp)
-        Stat.max_temperature = np.max(self.astronomical_night_temp)
+
+        self.Statistics.update(stats)
+
+    def night_events(self,Ephem):
+        '''
+        Astronomical nights and periods with the moon up (UTC) of
+        all the nights in the data. Lists of (start, end).
+        '''
+        twilights,moon_up = [],[]
+        for night,rows in self.nights:
+            Ephem.calculate_twilight(thedate=night)
+            Ephem.calculate_moon_ephems(thedate=night)
+            twilights.append((Ephem.twilight_prev_set,Ephem.twilight_next_rise))
+            moon_up.extend(Ephem.moon_up_intervals())
+        return(twilights,moon_up)
+
+    def sky_conditions(self,Ephem):
+        '''
+        statistics.TWILIGHT, MOON_UP or DARK for each row of the data
+        (all the nights).
+        '''
+        twilights,moon_up = self.night_events(Ephem)
+        return(statistics.classify_samples(self.data['utcdate'],twilights,moon_up))
+
+    def nights_statistics(self,Ephem,moonless=False):
+        '''
+        Statistics of all the nights in the data at once.
+        moonless: only the samples in astronomical night with the
+        moon below the horizon.
+        Return an array of statistics.NIGHT_STATS_DTYPE
+        (see also statistics.summary_tables).
+        '''
+        twilights,moon_up = self.night_events(Ephem)
+        mask = None
+        if moonless:
+            mask = statistics.classify_samples(\
+             self.data['utcdate'],twilights,moon_up)==statistics.DARK
+
+        return(statistics.night_statistics(self.nights,\
+         self.data['night_sb'],self.data['temperature'],\
+         self.data['utcdate'],twilights,mask=mask))
 
 
 class Plot(object):
     def __init__(self,Data,Ephem):
-        plt.hold(True)
-        Data = self.prepare_plot(Data,Ephem)
-        
+        '''
+        Make the figure. It can be reused for the same night,
+        calling update with the new data.
+        '''
         try: config.full_plot
         except: config.full_plot = False
-        if (config.full_plot)
+        if (config.full_plot):
             self.make_figure(thegraph_altsun=True,thegraph_time=True)
-            self.plot_data_sunalt(Data,Ephem)
         else:
             self.make_figure(thegraph_altsun=False,thegraph_time=True)
 
+        self.artists = {}
+        self.moon_spans = []
+        self.update(Data,Ephem)
+
+    def update(self,Data,Ephem):
+        '''
+        Plot the (new) data. Axes, locators and formatters are not
+        created again, only the data of the lines, texts, moon and
+        twilights is changed.
+        '''
+        self.Night = Data.Night
+        Data = self.prepare_plot(Data,Ephem)
+
+        if (config.full_plot):
+            self.plot_data_sunalt(Data,Ephem)
         self.plot_data_time(Data,Ephem)
 
         self.plot_moonphase(Ephem)
         self.plot_twilight(Ephem)
-        plt.hold(False)
+
+    def plot_line(self,graph,key,xdata,ydata,**kwargs):
+        # Create a line or update the data of an existing one.
+        # Downsample it to the width of the graph in the image.
+        try: config.plot_downsampling
+        except: config.plot_downsampling = True
+        if config.plot_downsampling:
+            width = graph.get_position().width*\
+             self.thefigure.get_figwidth()*getattr(config,'plot_dpi',150)
+            xdata,ydata = downsample_minmax(xdata,ydata,int(width))
+        # Matplotlib expects datetime objects for dates
+        if np.asarray(xdata).dtype.kind=='M':
+            xdata = np.asarray(xdata).astype(datetime.datetime)
+
+        try:
+            self.artists[key].set_data(xdata,ydata)
+        except KeyError:
+            self.artists[key], = graph.plot(xdata,ydata,**kwargs)
+
+    def plot_vline(self,graph,key,xvalue,**kwargs):
+        # Create a vertical line or move an existing one
+        try:
+            self.artists[key].set_xdata([xvalue,xvalue])
+        except KeyError:
+            self.artists[key] = graph.axvline(xvalue,**kwargs)
+
+    def plot_text(self,graph,key,xpos,ypos,text,**kwargs):
+        # Create a text or update an existing one
+        try:
+            self.artists[key].set_text(text)
+        except KeyError:
+            self.artists[key] = graph.text(xpos,ypos,text,\
+             transform=graph.transAxes,**kwargs)
 
     def plot_moonphase(self,Ephem):
         '''
         shade the period of time for which the moon is above the horizon
         '''
-        if Ephem.moon_next_rise > Ephem.moon_next_set:
-            # We need to divide the plotting in two phases
-            #(pre-midnight and after-midnight)
-            self.thegraph_time.axvspan(\
-             Ephem.moon_prev_rise+datetime.timedelta(hours=config._local_timezone),\
-             Ephem.moon_next_set+datetime.timedelta(hours=config._local_timezone),\
-              edgecolor='r',facecolor='r', alpha=0.1,clip_on=True)
-        else:
-            self.thegraph_time.axvspan(\
-             Ephem.moon_prev_rise+datetime.timedelta(hours=config._local_timezone),\
-             Ephem.moon_prev_set+datetime.timedelta(hours=config._local_timezone),\
-             edgecolor='r',facecolor='r', alpha=0.1,clip_on=True)
-            self.thegraph_time.axvspan(\
-             Ephem.moon_next_rise+datetime.timedelta(hours=config._local_timezone),\
-             Ephem.moon_next_set+datetime.timedelta(hours=config._local_timezone),\
-             edgecolor='r',facecolor='r', alpha=0.1,clip_on=True)
+        for span in self.moon_spans:
+            span.remove()
+
+        local_delta = datetime.timedelta(hours=config._local_timezone)
+        self.moon_spans = [self.thegraph_time.axvspan(\
+         rise+local_delta,moonset+local_delta,\
+         edgecolor='r',facecolor='r', alpha=0.1,clip_on=True) \
+         for rise,moonset in Ephem.moon_up_intervals()]
 
     def plot_twilight(self,Ephem):
         '''
         Plot vertical lines on the astronomical twilights
         '''
-        self.thegraph_time.axvline(\
+        self.plot_vline(self.thegraph_time,'twilight_set',\
          Ephem.twilight_prev_set+datetime.timedelta(hours=config._local_timezone),\
          color='k', ls='--', lw=2, alpha=0.5, clip_on=True)
-        self.thegraph_time.axvline(\
+        self.plot_vline(self.thegraph_time,'twilight_rise',\
          Ephem.twilight_next_rise+datetime.timedelta(hours=config._local_timezone),\
          color='k', ls='--', lw=2, alpha=0.5, clip_on=True)
 
@@ -523,20 +539,20 @@ class Plot(object):
         is used
         '''
 
-        if(len(Data.Night)!=1)
+        if(np.size(Data.Night)!=1):
             print('Warning, more than 1 night in the data file. '+\
                   'Please check it! %d' %np.size(Data.Night))
 
         # Mean datetime
-        dts       = Data.all_night_dt
-        mean_dt   = dts[0]+np.sum(np.array(dts)-dts[0])/np.size(dts)
-        sel_night = (mean_dt - datetime.timedelta(hours=12)).date()
+        dts       = Data.night_data['utcdate']
+        mean_dt   = dts[0]+np.mean(dts-dts[0])
+        sel_night = (mean_dt-np.timedelta64(12,'h')).astype('datetime64[D]')
 
-        Data.premidnight.filter = np.array(\
-         [Date.date()==sel_night for Date in Data.premidnight.localdates])
-        Data.aftermidnight.filter = np.array(\
-         [(Date-datetime.timedelta(days=1)).date()==sel_night\
-           for Date in Data.aftermidnight.localdates])
+        Data.premidnight.filter = \
+         Data.premidnight.column('localdate').astype('datetime64[D]')==sel_night
+        Data.aftermidnight.filter = \
+         (Data.aftermidnight.column('localdate')-np.timedelta64(1,'D'))\
+         .astype('datetime64[D]')==sel_night
 
         return(Data)
 
@@ -547,7 +563,7 @@ class Plot(object):
         # Plot the data
         TheData = Data.premidnight
         if np.size(TheData.filter)>0:
-            self.thegraph_sunalt.plot(\
+            self.plot_line(self.thegraph_sunalt,'sunalt_pm',\
              np.array(TheData.sun_altitude)[TheData.filter],\
              np.array(TheData.night_sbs)[TheData.filter],color='g')
             '''
@@ -557,7 +573,7 @@ class Plot(object):
             '''
         TheData = Data.aftermidnight
         if np.size(TheData.filter)>0:
-            self.thegraph_sunalt.plot(\
+            self.plot_line(self.thegraph_sunalt,'sunalt_am',\
              np.array(TheData.sun_altitude)[TheData.filter],\
              np.array(TheData.night_sbs)[TheData.filter],color='b')
             '''
@@ -575,15 +591,14 @@ class Plot(object):
         premidnight_label = str(Data.premidnight.label_dates).replace('[','').replace(']','')
         aftermidnight_label = str(Data.aftermidnight.label_dates).replace('[','').replace(']','')
 
-        self.thegraph_sunalt.text(0.00,1.015,\
+        self.plot_text(self.thegraph_sunalt,'sunalt_serial',0.00,1.015,\
          config._device_shorttype+'-'+config._observatory_name+' '*5+'Serial #'+str(Data.serial_number),\
-         color='0.25',fontsize='small',fontname='monospace',\
-         transform = self.thegraph_sunalt.transAxes)
+         color='0.25',fontsize='small',fontname='monospace')
 
-        self.thegraph_sunalt.text(0.75,0.92,'PM: '+premidnight_label,\
-         color='g',fontsize='small',transform = self.thegraph_sunalt.transAxes)
-        self.thegraph_sunalt.text(0.75,0.84,'AM: '+aftermidnight_label,\
-         color='b',fontsize='small',transform = self.thegraph_sunalt.transAxes)
+        self.plot_text(self.thegraph_sunalt,'sunalt_pm_label',0.75,0.92,'PM: '+premidnight_label,\
+         color='g',fontsize='small')
+        self.plot_text(self.thegraph_sunalt,'sunalt_am_label',0.75,0.84,'AM: '+aftermidnight_label,\
+         color='b',fontsize='small')
 
         '''
         if np.size(Data.Night)==1:
@@ -601,8 +616,8 @@ class Plot(object):
         # Plot the data (NSB and temperature)
         TheData = Data.premidnight
         if np.size(TheData.filter)>0:
-            self.thegraph_time.plot(\
-             np.array(TheData.localdates)[TheData.filter],\
+            self.plot_line(self.thegraph_time,'time_pm',\
+             TheData.column('localdate')[TheData.filter],\
              np.array(TheData.night_sbs)[TheData.filter],color='g')
             '''
             self.thegraph_time_temp.plot(\
@@ -613,8 +628,8 @@ class Plot(object):
 
         TheData = Data.aftermidnight
         if np.size(TheData.filter)>0:
-            self.thegraph_time.plot(\
-             np.array(TheData.localdates)[TheData.filter],\
+            self.plot_line(self.thegraph_time,'time_am',\
+             TheData.column('localdate')[TheData.filter],\
              np.array(TheData.night_sbs)[TheData.filter],color='b')
             '''
             self.thegraph_time_temp.plot(\
@@ -624,12 +639,12 @@ class Plot(object):
 
         
         # Vertical line to mark 0h
-        self.thegraph_time.axvline(\
+        self.plot_vline(self.thegraph_time,'midnight',\
          Data.Night+datetime.timedelta(days=1),color='k', alpha=0.5,clip_on=True)
 
         # Set the xlimit for the time plot.
         if np.size(Data.premidnight.filter)>0:
-            begin_plot_dt = Data.premidnight.localdates[-1]
+            begin_plot_dt = Data.premidnight.column('localdate')[-1].item()
             begin_plot_dt = datetime.datetime(\
              begin_plot_dt.year,\
              begin_plot_dt.month,\
@@ -638,7 +653,7 @@ class Plot(object):
             end_plot_dt = begin_plot_dt+datetime.timedelta(\
              hours=24+config.limits_time[1]-config.limits_time[0])
         elif np.size(Data.aftermidnight.filter)>0:
-            end_plot_dt = Data.aftermidnight.localdates[-1]
+            end_plot_dt = Data.aftermidnight.column('localdate')[-1].item()
             end_plot_dt = datetime.datetime(\
              end_plot_dt.year,\
              end_plot_dt.month,\
@@ -656,141 +671,282 @@ class Plot(object):
         premidnight_label = str(Data.premidnight.label_dates).replace('[','').replace(']','')
         aftermidnight_label = str(Data.aftermidnight.label_dates).replace('[','').replace(']','')
 
-        self.thegraph_time.text(0.00,1.015,\
+        self.plot_text(self.thegraph_time,'time_serial',0.00,1.015,\
          config._device_shorttype+'-'+config._observatory_name+' '*5+'Serial #'+str(Data.serial_number),\
-         color='0.25',fontsize='small',fontname='monospace',\
-         transform = self.thegraph_time.transAxes)
+         color='0.25',fontsize='small',fontname='monospace')
        
         if np.size(Data.Night)==1:
-            self.thegraph_time.text(0.75,1.015,'Moon: %d%s (%d%s)' \
+            self.plot_text(self.thegraph_time,'time_moon',0.75,1.015,'Moon: %d%s (%d%s)' \
              %(Ephem.moon_phase, "%", Ephem.moon_maxelev*180./np.pi,"$^\mathbf{o}$"),\
-             color='black',fontsize='small',fontname='monospace',\
-             transform = self.thegraph_time.transAxes)
+             color='black',fontsize='small',fontname='monospace')
         
     def save_figure(self,output_filename):
-        self.thefigure.savefig(output_filename, bbox_inches='tight',dpi=150)
+        self.save_figures([output_filename])
+
+    def render(self):
+        '''
+        Rasterize the figure once. Return the PNG file content.
+        '''
+        try: config.plot_dpi
+        except: config.plot_dpi = 150
+        buffer = io.BytesIO()
+        self.thefigure.savefig(buffer,format='png',bbox_inches='tight',dpi=config.plot_dpi)
+        return(buffer.getvalue())
+
+    def make_thumbnail(self,content,width):
+        '''
+        Reduce the rendered PNG, averaging blocks of pixels.
+        Return the PNG file content of the thumbnail.
+        '''
+        import matplotlib.image as mpimg
+        image = mpimg.imread(io.BytesIO(content))
+        factor = int(np.ceil(image.shape[1]*1./width))
+        if factor>1:
+            ny = image.shape[0]//factor
+            nx = image.shape[1]//factor
+            image = image[:ny*factor,:nx*factor].reshape(\
+             ny,factor,nx,factor,image.shape[2]).mean(axis=(1,3))
+        buffer = io.BytesIO()
+        mpimg.imsave(buffer,image,format='png')
+        return(buffer.getvalue())
+
+    def save_figures(self,output_filenames):
+        '''
+        Render the figure once and write it to all the output files.
+        Each file is replaced atomically (temp file and rename).
+        '''
+        try: config.plot_thumbnail_width
+        except: config.plot_thumbnail_width = None
+
+        content = self.render()
+        for output_filename in output_filenames:
+            cache.save_bytes(output_filename,content)
+
+        if config.plot_thumbnail_width:
+            thumbnail = self.make_thumbnail(content,config.plot_thumbnail_width)
+            for output_filename in output_filenames:
+                cache.save_bytes(\
+                 os.path.splitext(output_filename)[0]+'_thumb.png',thumbnail)
 
     def show_figure(self):
         plt.show(self.thefigure)
 
     def close_figure(self):
-        plt.close('all')
+        plt.close(self.thefigure)
 
 
-def save_stats_to_file(Night,NSBData,Ephem):
+def open_stats_store():
     '''
-    Save statistics to file
+    Return the statistics store, the CSV statistics filename and the
+    device name. The first time, the existing CSV file is imported.
     '''
-
-    Stat = NSBData.Statistics
-
-    Header = \
-     '# Summary statistics for '+str(config._device_shorttype+'_'+config._observatory_name)+'\n'+\
-     '# Description of columns (CSV file):\n'+\
-     '# Col 1: Date\n'+\
-     '# Col 2: Total measures\n'+\
-     '# Col 3: Number of Best NSB measures\n'+\
-     '# Col 4: Median of best N NSBs (mag/arcsec2)\n'+\
-     '# Col 5: Err in the median of best N NSBs (mag/arcsec2)\n'+\
-     '# Col 6: Number of terms of the low-freq fourier model\n'+\
-     '# Col 7: Mean of Abs diff of NSBs data - fourier model (mag/arcsec2)\n'+\
-     '# Col 8: Min Temp (C) between astronomical twilights\n'+\
-     '# Col 9: Max Temp (C) between astronomical twilights\n\n'
-
-    formatted_data = \
-        str(Night)+';'+\
-        str(Stat.number)+';'+\
-        str(Stat.bests_number)+';'+\
-        set_decimals(Stat.bests_median,4)+';'+\
-        set_decimals(Stat.bests_err,4)+';'+\
-        str(Stat.model_nterm)+';'+\
-        set_decimals(Stat.data_model_abs_meandiff,3)+';'+\
-        set_decimals(Stat.min_temperature,1)+';'+\
-        set_decimals(Stat.max_temperature,1)+\
-        '\n'
-
+    device_name = str(config._device_shorttype+'_'+config._observatory_name)
     statistics_filename = \
-     config.summary_data_directory+'/Statistics_'+\
-     str(config._device_shorttype+'_'+config._observatory_name)+'.dat'
+     config.summary_data_directory+'/Statistics_'+device_name+'.dat'
 
-    print('Writing statistics file')
+    store = statistics.StatisticsStore(\
+     os.path.splitext(statistics_filename)[0]+'.sqlite')
 
-    def safe_create_file(filename):
-        if not os.path.exists(filename):
-            open(filename, 'w').close()
+    # Keep the statistics of the old CSV file
+    if len(store)==0 and os.path.exists(statistics_filename):
+        store.import_csv(statistics_filename)
 
-    def read_file(filename):
-        thefile = open(filename,'r')
-        content = thefile.read()
-        thefile.close()
-        return(content)
+    return(store,statistics_filename,device_name)
 
-    def write_file(filename,content):
-        thefile = open(filename,'w')
-        thefile.write(content)
-        thefile.close()
 
-    def append_file(filename,content):
-        thefile = open(filename,'a')
-        thefile.write(content)
-        thefile.close()
+def export_stats_file():
+    '''
+    Write the CSV statistics file from the store
+    '''
+    store,statistics_filename,device_name = open_stats_store()
+    store.export_csv(statistics_filename,device_name)
+    store.close()
 
-    # Create file if not exists
-    safe_create_file(statistics_filename)
 
-    # Read the content
-    stat_file_content = read_file(statistics_filename)
+def heatmap_layout():
+    '''
+    Time of night bins of the heatmap, from the plot time limits.
+    Return start hour, hours, bin minutes and the layout name.
+    '''
+    try: config.heatmap_bin_minutes
+    except: config.heatmap_bin_minutes = 10
+    start_hour = config.limits_time[0]
+    hours = 24+config.limits_time[1]-config.limits_time[0]
+    return(start_hour,hours,config.heatmap_bin_minutes,\
+     statistics.bins_layout(start_hour,hours,config.heatmap_bin_minutes))
 
-    # If the file doesnt have a proper header, add it to the beginning
 
-    def valid_line(line):
-        if '#' in line:
-            return False
-        elif line.replace(' ','')=='':
-            return False
-        else:
-            return True
+def save_stats_to_file(Night,NSBData,Ephem):
+    '''
+    Save statistics (and the time of night bins for the heatmap)
+    to the store
+    '''
+
+    print('Writing statistics file')
 
-    if Header not in stat_file_content:
-        stat_file_content = [line for line in stat_file_content.split('\n') \
-         if valid_line(line)]
-        stat_file_content = '\n'.join(stat_file_content)
-        stat_file_content = Header+stat_file_content
-        write_file(statistics_filename,stat_file_content)
+    start_hour,hours,bin_minutes,layout = heatmap_layout()
+    store_night_statistics(Night,NSBData.Statistics,statistics.time_of_night_bins(\
+     NSBData.night_data['localdate'],NSBData.night_data['night_sb'],\
+     Night,start_hour,hours,bin_minutes))
 
-    # Remove any previous statistic for the given Night in the file
-    if str(Night) in stat_file_content:
-        stat_file_content = [line for line in stat_file_content.split('\n') \
-         if str(Night) not in line]
-        stat_file_content = '\n'.join(stat_file_content)
-        write_file(statistics_filename,stat_file_content)
 
-    # Append to the end of the file
-    append_file(statistics_filename,formatted_data)
+def store_night_statistics(Night,Stat,bins):
+    '''
+    Save the statistics (Stat object) and heatmap bins of a night
+    and write its row in the CSV file
+    '''
+    store,statistics_filename,device_name = open_stats_store()
+    store.save_night(Night,Stat)
+    start_hour,hours,bin_minutes,layout = heatmap_layout()
+    store.save_night_bins(Night,layout,bins)
+    if update_summaries:
+        store.update_csv(statistics_filename,device_name,Night)
+    store.close()
 
 
-def make_plot(input_filename=None,send_emails=False,write_stats=False):
+def save_night_statistics(Accumulator):
     '''
-    Main function (allows to execute the program
-    from within python.
-     - Extracts the NSB data from a given data file
-     - Performs statistics
-     - Save statistics to file
-     - Create the plot
+    Save the statistics of a night computed during the acquisition
+    (statistics.NightAccumulator) and update the heatmap.
+    The data file is not read.
     '''
+    print('Writing statistics file')
 
-    print('Ploting photometer data ...')
+    Stat = NightStatistics()
+    Stat.update(Accumulator.statistics()[0])
+    if not Stat.astronomical:
+        print(\
+         'Warning, < 10 points in astronomical night, '+\
+         ' using the whole night data instead')
 
-    if (input_filename is None):
-        input_filename  = config.current_data_directory+\
-         '/'+config._device_shorttype+'_'+config._observatory_name+'.dat'
+    start_hour,hours,bin_minutes,layout = heatmap_layout()
+    store_night_statistics(Accumulator.night,Stat,\
+     Accumulator.time_of_night_bins(start_hour,hours,bin_minutes))
 
-    # Define the observatory in ephem
-    Ephem = Ephemerids()
+    try: config.plot_heatmap
+    except: config.plot_heatmap = True
+    if update_summaries and config.plot_heatmap:
+        make_heatmap()
 
-    # Get and process the data from input_filename
-    NSBData = SQMData(input_filename,Ephem)
 
+def make_heatmap(first=None,last=None,output_filename=None):
+    '''
+    Long-term view of the NSB: an image with a row per night and
+    a column per bin of local time, colored by the median NSB.
+    It is made from the bins saved with the statistics of each night.
+    Return the output filename.
+    '''
+    start_hour,hours,bin_minutes,layout = heatmap_layout()
+    store,statistics_filename,device_name = open_stats_store()
+    nights,bins = store.read_night_bins(layout,first,last)
+    store.close()
+
+    if output_filename is None:
+        output_filename = config.summary_data_directory+'/Heatmap_'+device_name+'.png'
+    if np.size(nights)==0:
+        print('Warning, no data for the heatmap')
+        return(None)
+
+    # A row for every night in the range, also the ones without data
+    first_night,last_night = nights[0],nights[-1]
+    image = np.full((int((last_night-first_night).astype(int))+1,bins.shape[1]),np.nan)
+    image[(nights-first_night).astype(int)] = bins
+
+    figure = plt.figure(figsize=(7,max(3.,min(12.,2.+image.shape[0]/100.))))
+    graph = figure.add_subplot(1,1,1)
+    # Copy, the registered colormap is shared by all the figures
+    colormap = copy.copy(plt.get_cmap('viridis'))
+    colormap.set_bad('0.85')
+    first_num = mdates.date2num(first_night.item())
+    heatmap = graph.imshow(np.ma.masked_invalid(image),aspect='auto',\
+     interpolation='nearest',cmap=colormap,origin='upper',\
+     vmin=config.limits_nsb[0],vmax=config.limits_nsb[1],\
+     extent=[start_hour,start_hour+hours,first_num+image.shape[0]-0.5,first_num-0.5])
+
+    graph.yaxis_date()
+    graph.xaxis.set_major_locator(ticker.MultipleLocator(2))
+    graph.xaxis.set_major_formatter(\
+     ticker.FuncFormatter(lambda hour,pos: '%02d' %(hour%24)))
+    graph.set_xlabel('Local time (h)',fontsize='medium')
+    graph.text(0.00,1.015,\
+     config._device_shorttype+'-'+config._observatory_name,\
+     color='0.25',fontsize='small',fontname='monospace',transform=graph.transAxes)
+    colorbar = figure.colorbar(heatmap,ax=graph)
+    colorbar.set_label('Sky Brightness (mag/arcsec2)',fontsize='medium')
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer,format='png',bbox_inches='tight',\
+     dpi=getattr(config,'plot_dpi',150))
+    plt.close(figure)
+    cache.save_bytes(output_filename,buffer.getvalue())
+    return(output_filename)
+
+
+# Data already processed and figure made by make_plot, by filename.
+_sqmdata = {}
+_nsbplot = {}
+
+# Increase it when a change in the code changes the plots
+PLOT_CACHE_VERSION = 2
+
+def plot_fingerprint(input_filename):
+    '''
+    Identify the input data file (size and modification time) and
+    the options that change the plot and statistics.
+    '''
+    input_stat = os.stat(input_filename)
+    # (option, default value if it is not in the config)
+    options = [getattr(config,option,default) for option,default in [\
+     ('full_plot',False),('limits_nsb',None),('limits_time',None),\
+     ('limits_sunalt',None),('plot_dpi',150),('plot_thumbnail_width',None),\
+     ('plot_downsampling',True),('plot_heatmap',True),('heatmap_bin_minutes',10),\
+     ('_plot_corrected_data',False),('_offset_calibration',None),\
+     ('_local_timezone',None),\
+     ('_observatory_latitude',None),('_observatory_longitude',None),\
+     ('_observatory_altitude',None),('_observatory_horizon',None),\
+     ('_device_shorttype',None),('_observatory_name',None)]]
+    return(repr([PLOT_CACHE_VERSION,os.path.abspath(input_filename),\
+     input_stat.st_size,input_stat.st_mtime,options]))
+
+
+def plot_cache_filename(input_filename):
+    # Files with the same name can be in different directories
+    path_hash = hashlib.md5(os.path.abspath(input_filename).encode('utf-8')).hexdigest()
+    return(os.path.join(cache.cache_directory('plot'),\
+     '%s_%s.json' %(os.path.basename(input_filename),path_hash[:16])))
+
+
+def plot_is_updated(input_filename,write_stats=False):
+    '''
+    True if the plots (and statistics if requested) were already
+    made from the same data file and options.
+    '''
+    try:
+        record = json.load(open(plot_cache_filename(input_filename)))
+    except (IOError,OSError,ValueError):
+        return(False)
+
+    if record.get('fingerprint')!=plot_fingerprint(input_filename):
+        return(False)
+    if write_stats and not record.get('write_stats'):
+        return(False)
+    for output_filename in record.get('output_filenames',[]):
+        if not os.path.exists(output_filename):
+            return(False)
+    return(True)
+
+
+def save_plot_record(input_filename,fingerprint,output_filenames,write_stats=False):
+    record = {'fingerprint':fingerprint,\
+     'output_filenames':output_filenames,'write_stats':write_stats}
+    cache.save_bytes(plot_cache_filename(input_filename),\
+     json.dumps(record).encode('utf-8'))
+
+def make_night_plot(NSBData,Ephem,input_filename,write_stats=False,current_plot=True):
+    '''
+    Statistics and plot of the selected night (NSBData.Night).
+    Return the plot filenames.
+    '''
     # Moon and twilight ephemerids.
     Ephem.calculate_moon_ephems(thedate=NSBData.Night)
     Ephem.calculate_twilight(thedate=NSBData.Night)
@@ -802,27 +958,108 @@ def make_plot(input_filename=None,send_emails=False,write_stats=False):
     if write_stats==True:
         save_stats_to_file(NSBData.Night,NSBData,Ephem)
 
-    # Plot the data and save the resulting figure
-    NSBPlot = Plot(NSBData,Ephem)
+    # Plot the data and save the resulting figure.
+    # The figure is reused during the night, only the data is updated.
+    try:
+        NSBPlot = _nsbplot[input_filename]
+        assert(NSBPlot.Night==NSBData.Night)
+        NSBPlot.update(NSBData,Ephem)
+    except (KeyError,AssertionError):
+        for OldPlot in _nsbplot.values():
+            OldPlot.close_figure()
+        _nsbplot.clear()
+        NSBPlot = Plot(NSBData,Ephem)
+        _nsbplot[input_filename] = NSBPlot
 
     output_filenames = [\
-        str("%s/%s_%s.png" %(config.current_data_directory,config._device_shorttype,config._observatory_name)),\
         str("%s/%s_120000_%s-%s.png" \
             %(config.daily_graph_directory, str(NSBData.Night).replace('-',''),\
               config._device_shorttype, config._observatory_name))\
     ]
+    if current_plot:
+        output_filenames.insert(0,\
+         str("%s/%s_%s.png" %(config.current_data_directory,config._device_shorttype,config._observatory_name)))
+
+    NSBPlot.save_figures(output_filenames)
+    return(output_filenames)
+
+
+# Update the CSV statistics file and the heatmap each time the
+# statistics are saved. Disabled when many nights are
+# processed (see pysqm.reprocess), they are updated once at the end.
+update_summaries = True
+
+def make_plot(input_filename=None,send_emails=False,write_stats=False,\
+ current_plot=True,force=False):
+    '''
+    Main function (allows to execute the program
+    from within python.
+     - Extracts the NSB data from a given data file
+     - Performs statistics
+     - Save statistics to file
+     - Create the plot
+    current_plot: also update the plot of the current night.
+    force: make the plot even if it is up to date.
+    Return the plot filenames (empty if there is no valid data),
+    None if the plot was up to date.
+    '''
+
+    print('Ploting photometer data ...')
+
+    create_directories()
 
-    for output_filename in output_filenames:
-        NSBPlot.save_figure(output_filename)
+    if (input_filename is None):
+        input_filename  = config.current_data_directory+\
+         '/'+config._device_shorttype+'_'+config._observatory_name+'.dat'
 
-    # Close figure
-    NSBPlot.close_figure()
+    # Nothing to do if the data file didnt change since the last plot.
+    # The emails need the statistics, so they always process the data.
+    if not (send_emails or force) and plot_is_updated(input_filename,write_stats):
+        print('Plot is up to date')
+        return
+
+    # Before reading, so data appended while we plot is not missed
+    fingerprint = plot_fingerprint(input_filename)
+
+    # Define the observatory in ephem
+    Ephem = Ephemerids()
+
+    # Get and process the data from input_filename.
+    # Keep it between calls, only new lines will be read next time.
+    try:
+        NSBData = _sqmdata[input_filename]
+        NSBData.update(Ephem)
+    except KeyError:
+        NSBData = SQMData(input_filename,Ephem)
+        _sqmdata.clear()
+        _sqmdata[input_filename] = NSBData
+
+    # Statistics and plot of each night in the file.
+    # The current plot shows the last one.
+    output_filenames = []
+    for night,rows in NSBData.nights:
+        NSBData.select_night(night)
+        output_filenames += make_night_plot(NSBData,Ephem,input_filename,\
+         write_stats=write_stats,\
+         current_plot=(current_plot and night==NSBData.nights[-1][0]))
+
+    # A file without valid data is processed again next time
+    if output_filenames:
+        save_plot_record(input_filename,fingerprint,output_filenames,write_stats)
+
+    # Update the long-term heatmap with the new night(s)
+    try: config.plot_heatmap
+    except: config.plot_heatmap = True
+    if write_stats and update_summaries and config.plot_heatmap:
+        make_heatmap()
 
     if send_emails == True:
         import pysqm.email
         night_label = str(datetime.date.today()-timedelta(days=1))
         pysqm.email.send_emails(night_label=night_label,Stat=NSBData.Statistics)
 
+    return(output_filenames)
+
 
 '''
 The following code allows to execute plot.py as a standalone program.
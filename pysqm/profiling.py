@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+'''
+PySQM on-demand profiling
+____________________________
+
+Copyright (c) Miguel Nievas <miguelnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Diagnose a running daemon with signals (not available on Windows):
+
+ kill -USR1 <pid>  Start cProfile on the main loop. It is stopped after
+                   _profiling_seconds (at the next iteration of the loop)
+                   or with a second SIGUSR1, and the stats are written
+                   to profile_<timestamp>_<n>.prof/.txt
+ kill -USR2 <pid>  Write the stacks of all the threads and the memory
+                   growth since the previous SIGUSR2 to
+                   memory_<timestamp>_<n>.txt: the number of objects
+                   by type (gc) that grew most, or with python >= 3.4
+                   the allocations by line (the first SIGUSR2 starts
+                   tracemalloc).
+
+Only the signal handlers are installed at startup, nothing is traced
+until a signal is received.
+____________________________
+'''
+
+import os,sys
+import time
+import signal
+import threading
+import traceback
+
+from pysqm.cache import make_directory
+
+
+class Profiler(object):
+    def __init__(self,directory,seconds=60):
+        self.directory = directory
+        self.seconds = seconds
+        self.profile = None
+        self.snapshot = None
+        self.type_counts = None
+        # Number of files written, so two signals in the same
+        # second dont overwrite each other
+        self.outputs = 0
+
+    def output_filename(self,prefix,extension):
+        make_directory(self.directory)
+        self.outputs += 1
+        return('%s/%s_%s_%d.%s' %(self.directory,prefix,\
+         time.strftime('%Y%m%d_%H%M%S'),self.outputs,extension))
+
+    def toggle_profile(self,signum=None,frame=None):
+        ''' SIGUSR1 handler. Runs in the main thread. '''
+        if self.profile is None:
+            import cProfile
+            print('Profiling the main loop for %d s' %self.seconds)
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            # cProfile must be stopped from the main thread, the main
+            # loop does it in poll() once the time is over.
+            self.stop_time = time.time()+self.seconds
+        else:
+            self.stop_profile()
+
+    def stop_profile(self):
+        self.profile.disable()
+        self.dump_profile(self.profile)
+        self.profile = None
+
+    def poll(self):
+        ''' Called by the main loop in each iteration '''
+        if self.profile is not None and time.time()>=self.stop_time:
+            self.stop_profile()
+
+    def dump_profile(self,profile):
+        import pstats
+        filename = self.output_filename('profile','prof')
+        profile.dump_stats(filename)
+        textfile = open(filename[:-len('prof')]+'txt','w')
+        stats = pstats.Stats(filename,stream=textfile)
+        stats.sort_stats('cumulative').print_stats(50)
+        textfile.close()
+        print('Profile written to '+filename)
+
+    def dump_memory(self,signum=None,frame=None):
+        ''' SIGUSR2 handler: thread stacks and memory growth '''
+        lines = []
+        thread_names = dict([(th.ident,th.name) for th in threading.enumerate()])
+        for ident,stack in sys._current_frames().items():
+            lines.append('# Thread %s (%s)' %(ident,thread_names.get(ident,'')))
+            lines.extend([l.rstrip('\n') for l in traceback.format_stack(stack)])
+            lines.append('')
+
+        try:
+            import tracemalloc
+        except ImportError:
+            lines.extend(self.object_growth())
+        else:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                lines.append('# tracemalloc started, send SIGUSR2 again to get the diff')
+            else:
+                snapshot = tracemalloc.take_snapshot()
+                if self.snapshot is None:
+                    lines.append('# Top allocations')
+                    statistics = snapshot.statistics('lineno')
+                else:
+                    lines.append('# Top allocation differences since the last snapshot')
+                    statistics = snapshot.compare_to(self.snapshot,'lineno')
+                lines.extend([str(stat) for stat in statistics[:50]])
+                self.snapshot = snapshot
+
+        filename = self.output_filename('memory','txt')
+        thefile = open(filename,'w')
+        thefile.write('\n'.join(lines)+'\n')
+        thefile.close()
+        print('Stacks and memory report written to '+filename)
+
+    def object_growth(self):
+        '''
+        Python 2 (no tracemalloc): count the objects tracked by gc by
+        type and report the types that grew most since the last call.
+        '''
+        import gc
+        gc.collect()
+        counts = {}
+        for obj in gc.get_objects():
+            kind = type(obj)
+            name = '%s.%s' %(getattr(kind,'__module__','?'),kind.__name__)
+            counts[name] = counts.get(name,0)+1
+
+        if self.type_counts is None:
+            lines = ['# Objects by type (gc), send SIGUSR2 again to get the growth']
+            rows = sorted([(count,count,name) for name,count in counts.items()],\
+             reverse=True)
+        else:
+            lines = ['# Types of objects that grew most since the last SIGUSR2 (gc)']
+            rows = sorted([(count-self.type_counts.get(name,0),count,name) \
+             for name,count in counts.items() \
+             if count>self.type_counts.get(name,0)],reverse=True)
+        lines.append('# %8s %8s type' %('growth','number'))
+        lines.extend(['%+10d %8d %s' %row for row in rows[:50]])
+        self.type_counts = counts
+        return(lines)
+
+
+def install(config):
+    '''
+    Install the signal handlers.
+    Must be called from the main thread.
+    '''
+    if not hasattr(signal,'SIGUSR1'):
+        # Windows
+        return(None)
+
+    try: config._profiling_directory
+    except: config._profiling_directory = config.monthly_data_directory+'/profiling'
+    try: config._profiling_seconds
+    except: config._profiling_seconds = 60
+
+    profiler = Profiler(config._profiling_directory,config._profiling_seconds)
+    signal.signal(signal.SIGUSR1,profiler.toggle_profile)
+    signal.signal(signal.SIGUSR2,profiler.dump_memory)
+    # Restart the system calls (serial port, sockets) that are waiting
+    # when a signal arrives, instead of failing with EINTR.
+    signal.siginterrupt(signal.SIGUSR1,False)
+    signal.siginterrupt(signal.SIGUSR2,False)
+    return(profiler)
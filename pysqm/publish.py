@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+'''
+PySQM live sample broadcast
+____________________________
+
+Copyright (c) Miguel Nievas <miguelnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Send each sample of the daemon to any number of local programs
+(displays, loggers, alarms...), one datagram per sample:
+
+ _publish_socket     Unix domain datagram socket. Subscribers send
+                     'SUB' to it (and again from time to time) and get
+                     the samples in their own socket. A subscriber that
+                     is gone or doesnt read fast enough is dropped.
+ _publish_multicast  'group:port' UDP multicast (TTL 1, this network).
+
+Datagram (PACKET_DTYPE, 60 bytes, little endian): 'SQM1', sequence
+number (uint64) and the sample as a ringbuffer.SAMPLE_DTYPE record.
+The daemon never waits for the subscribers (non-blocking sockets).
+Use Subscriber to receive them:
+
+ for sequence,sample in Subscriber(socket_path='/tmp/pysqm.sock'):
+     print(sample['utcdate'],sample['night_sb'])
+____________________________
+'''
+
+import os,sys
+import time
+import socket
+import struct
+import shutil
+import tempfile
+import numpy as np
+
+import pysqm.metrics as metrics
+from pysqm.ringbuffer import SAMPLE_DTYPE
+
+MAGIC = b'SQM1'
+PACKET_DTYPE = np.dtype([('magic','S4'),('sequence','<u8'),('sample',SAMPLE_DTYPE)])
+
+SUBSCRIBE = b'SUB'
+UNSUBSCRIBE = b'UNSUB'
+
+# Seconds between two subscription requests of a Subscriber
+RESUBSCRIBE_INTERVAL = 30
+
+
+def encode(sequence,record):
+    packet = np.zeros(1,dtype=PACKET_DTYPE)
+    packet['magic'] = MAGIC
+    packet['sequence'] = sequence
+    packet['sample'] = record
+    return(packet.tobytes())
+
+
+def decode(datagram):
+    ''' Return (sequence, sample record), None if it is not a packet '''
+    if len(datagram)!=PACKET_DTYPE.itemsize or not datagram.startswith(MAGIC):
+        return(None)
+    packet = np.frombuffer(datagram,dtype=PACKET_DTYPE)[0]
+    return(int(packet['sequence']),packet['sample'])
+
+
+def parse_multicast(address):
+    # 'group:port' -> (group, port)
+    group,port = str(address).rsplit(':',1)
+    return(group,int(port))
+
+
+class Publisher(object):
+    '''
+    Send the samples to the subscribers of the Unix socket and/or
+    to the multicast group.
+    '''
+    def __init__(self,socket_path=None,multicast=None):
+        self.sequence = 0
+        self.subscribers = {}
+        self.unix_socket = None
+        self.multicast_socket = None
+        self.socket_path = socket_path
+        self.multicast = None
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                # Left by a previous run
+                os.remove(socket_path)
+            self.unix_socket = socket.socket(socket.AF_UNIX,socket.SOCK_DGRAM)
+            self.unix_socket.bind(socket_path)
+            self.unix_socket.setblocking(False)
+
+        if multicast is not None:
+            self.multicast = parse_multicast(multicast)
+            self.multicast_socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+            self.multicast_socket.setsockopt(socket.IPPROTO_IP,socket.IP_MULTICAST_TTL,1)
+            self.multicast_socket.setblocking(False)
+
+    def read_requests(self):
+        # Subscription requests received since the last sample
+        while True:
+            try: request,address = self.unix_socket.recvfrom(64)
+            except socket.error:
+                return
+            if not address: continue
+            if request==SUBSCRIBE:
+                self.subscribers[address] = time.time()
+            elif request==UNSUBSCRIBE:
+                self.subscribers.pop(address,None)
+
+    def publish(self,record):
+        ''' Send a SAMPLE_DTYPE record (see ringbuffer.sample_record) '''
+        self.sequence += 1
+        datagram = encode(self.sequence,record)
+
+        if self.unix_socket is not None:
+            self.read_requests()
+            for address in list(self.subscribers):
+                try: self.unix_socket.sendto(datagram,address)
+                except socket.error:
+                    # Queue full (slow subscriber) or subscriber gone
+                    del self.subscribers[address]
+                    metrics.counter('pysqm_publish_dropped_total',\
+                     'Subscribers dropped because they dont read').inc()
+
+        if self.multicast_socket is not None:
+            try: self.multicast_socket.sendto(datagram,self.multicast)
+            except socket.error:
+                metrics.counter('pysqm_publish_errors_total',\
+                 'Samples that could not be sent to the multicast group').inc()
+
+    def close(self):
+        if self.unix_socket is not None:
+            self.unix_socket.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        if self.multicast_socket is not None:
+            self.multicast_socket.close()
+
+
+class Subscriber(object):
+    '''
+    Receive the samples of a Publisher, from its Unix socket or from
+    the multicast group. Iterate over it, or call receive().
+    '''
+    def __init__(self,socket_path=None,multicast=None,\
+     resubscribe=RESUBSCRIBE_INTERVAL):
+        self.socket_path = socket_path
+        self.resubscribe = resubscribe
+        self.subscribed = None
+        if socket_path is not None:
+            self.directory = tempfile.mkdtemp(prefix='pysqm_')
+            self.socket = socket.socket(socket.AF_UNIX,socket.SOCK_DGRAM)
+            self.socket.bind(os.path.join(self.directory,'subscriber.sock'))
+            self.subscribe()
+        elif multicast is not None:
+            self.directory = None
+            group,port = parse_multicast(multicast)
+            self.socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+            self.socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+            self.socket.bind(('',port))
+            self.socket.setsockopt(socket.IPPROTO_IP,socket.IP_ADD_MEMBERSHIP,\
+             struct.pack('4s4s',socket.inet_aton(group),socket.inet_aton('0.0.0.0')))
+        else:
+            raise ValueError('socket_path or multicast is needed')
+
+    def subscribe(self):
+        # Also after a restart of the daemon or if we were dropped
+        self.subscribed = time.time()
+        try: self.socket.sendto(SUBSCRIBE,self.socket_path)
+        except socket.error: pass
+
+    def receive(self,timeout=None):
+        '''
+        Wait for the next sample, at most timeout seconds.
+        Return (sequence, sample record) or None.
+        '''
+        deadline = None if timeout is None else time.time()+timeout
+        while True:
+            wait = self.resubscribe if self.socket_path is not None else None
+            if deadline is not None:
+                remaining = deadline-time.time()
+                if remaining<=0: return(None)
+                wait = remaining if wait is None else min(wait,remaining)
+            self.socket.settimeout(wait)
+            try: datagram = self.socket.recv(PACKET_DTYPE.itemsize+1)
+            except socket.timeout: datagram = None
+            if self.socket_path is not None and \
+             time.time()-self.subscribed>=self.resubscribe:
+                self.subscribe()
+            if datagram is not None:
+                packet = decode(datagram)
+                if packet is not None: return(packet)
+
+    def __iter__(self):
+        while True:
+            yield(self.receive())
+
+    def close(self):
+        if self.socket_path is not None:
+            try: self.socket.sendto(UNSUBSCRIBE,self.socket_path)
+            except socket.error: pass
+        self.socket.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory,ignore_errors=True)
+
+
+def open_publisher(config):
+    '''
+    Publisher for the sockets set in the config (_publish_socket,
+    _publish_multicast), None if none is configured.
+    '''
+    try: config._publish_socket
+    except: config._publish_socket = None
+    try: config._publish_multicast
+    except: config._publish_multicast = None
+
+    if config._publish_socket is None and config._publish_multicast is None:
+        return(None)
+    try:
+        return(Publisher(config._publish_socket,config._publish_multicast))
+    except Exception as e:
+        print('Warning: cannot open the publish sockets: '+str(e))
+        return(None)
@@ -30,7 +30,6 @@ import time
 import datetime
 import numpy as np
 import struct
-import socket
 
 # Default, to ignore the length of the read string.
 _cal_len_  = None
@@ -38,19 +37,7 @@ _meta_len_ = None
 _data_len_ = None
 
 from pysqm.common import *
-
-'''
-This import section is only for software build purposes.
-Dont worry if some of these are missing in your setup.
-'''
-
-def relaxed_import(themodule):
-    try: exec('import '+str(themodule))
-    except: pass
-
-relaxed_import('serial')
-relaxed_import('_mysql')
-relaxed_import('pysqm.email')
+import pysqm.metrics as metrics
 
 '''
 Read configuration
@@ -64,7 +51,9 @@ except:
     DEBUG=False
 
 '''
-Conditional imports
+Conditional imports.
+Only the modules needed by the configured device and sinks are loaded,
+this keeps the daemon startup fast on small hosts (Raspberry Pi).
 '''
 
 # If the old format (SQM_LE/SQM_LU) is used, replace _ with -
@@ -225,6 +214,9 @@ class device(observatory):
         node @ UCM. It saves the data there (only the SQM data file contents)
         '''
 
+        # SQM-LU setups do not load socket at startup
+        import socket
+
         # Connection details (hardcoded to avoid user changes)
         DC_HOST = "muon.gae.ucm.es"
         DC_PORT = 8739
@@ -319,13 +311,17 @@ class device(observatory):
         self.DataCache = self.DataCache+formatted_data
 
         if len(self.DataCache.split("\n"))>=number_measures+1:
-            self.save_data(self.DataCache)
+            with metrics.timer('pysqm_cache_flush_seconds',\
+             'Time to write the data cache to the data files'):
+                self.save_data(self.DataCache)
             self.DataCache = ""
             print(str(niter)+'\t'+formatted_data[:-1])
 
     def flush_cache(self):
         ''' Flush the data cache '''
-        self.save_data(self.DataCache)
+        with metrics.timer('pysqm_cache_flush_seconds',\
+         'Time to write the data cache to the data files'):
+            self.save_data(self.DataCache)
         self.DataCache = ""
 
     def copy_file(self,source,destination):
@@ -362,9 +358,13 @@ class SQM(device):
             InitialDateTime = datetime.datetime.now()
 
             # Get the raw data from the photometer and process it.
-            raw_data = self.read_data(tries=10)
-            temp_sensor_i,freq_sensor_i,ticks_uC_i,sky_brightness_i = \
-             self.data_process(raw_data)
+            with metrics.timer('pysqm_device_roundtrip_seconds',\
+             'Time to request and read a measure from the photometer'):
+                raw_data = self.read_data(tries=10)
+            with metrics.timer('pysqm_parse_seconds',\
+             'Time to parse the photometer answer'):
+                temp_sensor_i,freq_sensor_i,ticks_uC_i,sky_brightness_i = \
+                 self.data_process(raw_data)
 
             temp_sensor += [temp_sensor_i]
             freq_sensor += [freq_sensor_i]
@@ -387,10 +387,12 @@ class SQM(device):
         timelocal_mean = self.local_datetime(timeutc_mean)
 
         # Calculate the mean of the data.
-        temp_sensor = filtered_mean(temp_sensor)
-        freq_sensor = filtered_mean(freq_sensor)
-        flux_sensor = filtered_mean(flux_sensor)
-        ticks_uC    = filtered_mean(ticks_uC)
+        with metrics.timer('pysqm_filtered_mean_seconds',\
+         'Time to compute the filtered means of a sample'):
+            temp_sensor = filtered_mean(temp_sensor)
+            freq_sensor = filtered_mean(freq_sensor)
+            flux_sensor = filtered_mean(flux_sensor)
+            ticks_uC    = filtered_mean(ticks_uC)
         sky_brightness = -2.5*np.log10(flux_sensor)
 
         # Correct from offset (if cover is installed on the photometer)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+'''
+PySQM archive reprocessing
+____________________________
+
+Copyright (c) Miguel Nievas <miguelnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Regenerate the plots and statistics of the daily data files,
+in parallel. Usage:
+
+ python -m pysqm.reprocess -c config.py [paths] [--from DATE] [--to DATE]
+
+paths are daily .dat files or directories with them (by default the
+daily_data_directory of the config). Files whose plot is up to date
+are skipped, so an interrupted run can just be started again (use
+--force to make all the plots again). The files that fail are
+written, with the error, to the failure log.
+
+The CSV statistics file (Statistics_<device>.dat) is written at the
+end. To write it (and the heatmap) from the statistics store without
+processing any file:
+
+ python -m pysqm.reprocess -c config.py --export-stats
+____________________________
+'''
+
+import os,sys
+import time
+import datetime
+import argparse
+import traceback
+import multiprocessing
+
+import pysqm.settings as settings
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pysqm.reprocess',\
+     description='Regenerate the plots and statistics of the daily data files')
+    parser.add_argument('-c','--config',default='config.py',\
+     help='configuration file')
+    parser.add_argument('paths',nargs='*',\
+     help='daily data files or directories (default: daily_data_directory)')
+    parser.add_argument('--from',dest='date_from',type=parse_date,\
+     help='first night to process (YYYY-MM-DD)')
+    parser.add_argument('--to',dest='date_to',type=parse_date,\
+     help='last night to process (YYYY-MM-DD)')
+    parser.add_argument('-j','--jobs',type=int,default=multiprocessing.cpu_count(),\
+     help='number of processes (default: number of cpus)')
+    parser.add_argument('--force',action='store_true',\
+     help='make the plots even if they are up to date')
+    parser.add_argument('--no-stats',dest='write_stats',action='store_false',\
+     help='dont write the statistics file')
+    parser.add_argument('--export-stats',action='store_true',\
+     help='only write the CSV statistics file (and the heatmap) from '+\
+          'the statistics store')
+    parser.add_argument('--failure-log',\
+     help='file for the failed files (default: reprocess_failures.log '+\
+          'in monthly_data_directory)')
+    parser.add_argument('-v','--verbose',action='store_true',\
+     help='show the output of each plot (always shown with -j 1)')
+    return(parser.parse_args(argv))
+
+
+def parse_date(text):
+    return(datetime.datetime.strptime(text,'%Y-%m-%d').date())
+
+
+def file_night(filename):
+    '''
+    Night of a daily file, from its name (YYYYMMDD_120000_...)
+    None if the name doesnt start with a date.
+    '''
+    try:
+        return(datetime.datetime.strptime(\
+         os.path.basename(filename)[0:8],'%Y%m%d').date())
+    except ValueError:
+        return(None)
+
+
+def find_files(paths,date_from=None,date_to=None):
+    '''
+    List the .dat files in paths (files or directories), sorted by
+    name, and keep those in the date range (if given).
+    '''
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory,subdirs,files in os.walk(path):
+                filenames.extend([os.path.join(directory,name) \
+                 for name in files if name.endswith('.dat')])
+        else:
+            filenames.append(path)
+
+    if date_from is not None or date_to is not None:
+        def in_range(filename):
+            night = file_night(filename)
+            if night is None: return(False)
+            if date_from is not None and night<date_from: return(False)
+            if date_to is not None and night>date_to: return(False)
+            return(True)
+        filenames = [filename for filename in filenames if in_range(filename)]
+
+    return(sorted(set(filenames),key=os.path.basename))
+
+
+def load_config(config_filename):
+    settings.GlobalConfig.read_config_file(config_filename)
+    import pysqm.plot
+    # The CSV file and the heatmap are updated once at the end
+    pysqm.plot.update_summaries = False
+
+
+def init_worker(config_filename,verbose=False):
+    # Executed once in each process of the pool
+    load_config(config_filename)
+    if not verbose:
+        sys.stdout = open(os.devnull,'w')
+
+
+def process_file(task):
+    '''
+    Make the plot (and statistics) of one file.
+    Return (filename, status, elapsed seconds, error)
+    '''
+    filename,write_stats,force = task
+    import pysqm.plot
+    start = time.time()
+    try:
+        if not force and pysqm.plot.plot_is_updated(filename,write_stats):
+            return(filename,'skipped',time.time()-start,None)
+        output_filenames = pysqm.plot.make_plot(input_filename=filename,\
+         write_stats=write_stats,current_plot=False,force=force)
+    except Exception:
+        return(filename,'failed',time.time()-start,traceback.format_exc())
+    if output_filenames==[]:
+        return(filename,'failed',time.time()-start,\
+         'No valid data (no night) in the file\n')
+    return(filename,'done',time.time()-start,None)
+
+
+def log_failure(log_filename,filename,error):
+    log_file = open(log_filename,'a')
+    log_file.write('# %s %s\n%s\n' %(\
+     datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),filename,error))
+    log_file.close()
+
+
+def export_summaries():
+    # CSV statistics file and heatmap, from the statistics store
+    import pysqm.plot
+    pysqm.plot.export_stats_file()
+    if getattr(pysqm.plot.config,'plot_heatmap',True):
+        pysqm.plot.make_heatmap()
+
+
+def reprocess(filenames,config_filename,jobs=1,write_stats=True,\
+ force=False,failure_log=None,verbose=False):
+    '''
+    Process the files in a pool of jobs processes, printing the progress.
+    Return a dict with the number of files by status.
+    '''
+    tasks = [(filename,write_stats,force) for filename in filenames]
+    summary = {'done':0,'skipped':0,'failed':0}
+
+    if jobs>1:
+        pool = multiprocessing.Pool(jobs,init_worker,\
+         (config_filename,verbose))
+        results = pool.imap_unordered(process_file,tasks)
+    else:
+        # The output of the plots is shown, stdout is the one of
+        # the main process
+        pool = None
+        load_config(config_filename)
+        results = (process_file(task) for task in tasks)
+
+    start = time.time()
+    try:
+        for k,(filename,status,elapsed,error) in enumerate(results):
+            summary[status] += 1
+            if status=='failed' and failure_log is not None:
+                log_failure(failure_log,filename,error)
+            sys.__stdout__.write('[%*d/%d] %-8s %s (%.1f s)\n' %(\
+             len(str(len(tasks))),k+1,len(tasks),status,\
+             os.path.basename(filename),elapsed))
+            sys.__stdout__.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if write_stats and summary['done']:
+        export_summaries()
+
+    sys.__stdout__.write('%d done, %d skipped, %d failed in %.1f s\n' %(\
+     summary['done'],summary['skipped'],summary['failed'],time.time()-start))
+    if summary['failed'] and failure_log is not None:
+        sys.__stdout__.write('Failures written to %s\n' %failure_log)
+    return(summary)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    config_filename = os.path.abspath(args.config)
+    settings.GlobalConfig.read_config_file(config_filename)
+    config = settings.GlobalConfig.config
+
+    if args.export_stats:
+        export_summaries()
+        return(0)
+
+    paths = args.paths or [config.daily_data_directory]
+    filenames = find_files(paths,args.date_from,args.date_to)
+    if not filenames:
+        print('No data files to process')
+        return(0)
+
+    if args.write_stats:
+        # The first time, import the old CSV statistics file before
+        # the workers start saving nights
+        import pysqm.plot
+        pysqm.plot.open_stats_store()[0].close()
+
+    failure_log = args.failure_log or \
+     os.path.join(config.monthly_data_directory,'reprocess_failures.log')
+
+    summary = reprocess(filenames,config_filename,\
+     jobs=max(1,min(args.jobs,len(filenames))),write_stats=args.write_stats,\
+     force=args.force,failure_log=failure_log,verbose=args.verbose)
+    return(1 if summary['failed'] else 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+'''
+PySQM live sample ring buffer
+____________________________
+
+Copyright (c) Miguel Nievas <miguelnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+The daemon writes each sample (if _ringbuffer_file is set) in a
+memory mapped file, so other programs in the computer can get the
+last readings without parsing (or locking) the data files.
+
+File layout (little endian):
+
+ Header, 64 bytes (HEADER_DTYPE)
+  0  magic        8 bytes  'PYSQMRB1'
+  8  version      uint32   1
+ 12  header_size  uint32   64
+ 16  capacity     uint32   number of record slots
+ 20  record_size  uint32   48 (SAMPLE_DTYPE.itemsize)
+ 24  sequence     uint64   number of records written since the file
+                           was created
+ 32  reserved     32 bytes
+ Records, capacity x 48 bytes (SAMPLE_DTYPE)
+  0  utcdate      datetime64[s] (int64, seconds since 1970-01-01)
+  8  localdate    datetime64[s]
+ 16  temperature  float64  C
+ 24  tick_counts  float64
+ 32  frequency    float64  Hz
+ 40  night_sb     float64  mag/arcsec2
+
+Record number n is in the slot n % capacity. The writer fills the slot
+and then increments the sequence. The slot of record sequence-capacity
+is the next one to be written (it may be being written now), so the
+records sequence-capacity+1 .. sequence-1 are available: at most
+capacity-1 records. There are no locks: the reader copies the records
+and reads the sequence again to discard the slots that were
+overwritten meanwhile (RingReader does it).
+____________________________
+'''
+
+import os,sys
+import numpy as np
+
+from pysqm.cache import make_directory,write_file
+
+MAGIC = b'PYSQMRB1'
+VERSION = 1
+
+HEADER_DTYPE = np.dtype([('magic','S8'),('version','<u4'),\
+ ('header_size','<u4'),('capacity','<u4'),('record_size','<u4'),\
+ ('sequence','<u8'),('reserved','S32')])
+
+SAMPLE_DTYPE = np.dtype([('utcdate','<M8[s]'),('localdate','<M8[s]'),\
+ ('temperature','<f8'),('tick_counts','<f8'),('frequency','<f8'),\
+ ('night_sb','<f8')])
+
+# Number of records kept by default (~5.8 days at 1 sample every 5 s)
+DEFAULT_CAPACITY = 100000
+
+
+def valid_header(header):
+    return(header['magic']==MAGIC and header['version']==VERSION and \
+     header['header_size']==HEADER_DTYPE.itemsize and \
+     header['record_size']==SAMPLE_DTYPE.itemsize)
+
+
+def read_header(filename):
+    ''' Header of a ring buffer file, None if it is not valid '''
+    try:
+        ring_file = open(filename,'rb')
+        content = ring_file.read(HEADER_DTYPE.itemsize)
+        ring_file.close()
+    except (IOError,OSError):
+        return(None)
+    if len(content)<HEADER_DTYPE.itemsize: return(None)
+    header = np.frombuffer(content,dtype=HEADER_DTYPE)[0]
+    if not valid_header(header): return(None)
+    return(header)
+
+
+def sample_record(utcdate,localdate,temperature,tick_counts,frequency,night_sb):
+    ''' One SAMPLE_DTYPE record from the values of a reading '''
+    return(np.array((np.datetime64(utcdate,'s'),np.datetime64(localdate,'s'),\
+     temperature,tick_counts,frequency,night_sb),dtype=SAMPLE_DTYPE))
+
+
+class RingWriter(object):
+    '''
+    Write samples to the ring buffer file. An existing file with the
+    same capacity is reused (readers keep working and the sequence
+    continues), otherwise a new file is renamed over it (the readers
+    map the new one, see RingReader.check).
+    '''
+    def __init__(self,filename,capacity=DEFAULT_CAPACITY):
+        self.filename = filename
+        self.capacity = int(capacity)
+        header = read_header(filename)
+        if header is None or header['capacity']!=self.capacity or \
+         os.path.getsize(filename)!=self.file_size():
+            self.create()
+        self.header = np.memmap(filename,dtype=HEADER_DTYPE,mode='r+',shape=(1,))
+        self.records = np.memmap(filename,dtype=SAMPLE_DTYPE,mode='r+',\
+         offset=HEADER_DTYPE.itemsize,shape=(self.capacity,))
+
+    def file_size(self):
+        return(HEADER_DTYPE.itemsize+self.capacity*SAMPLE_DTYPE.itemsize)
+
+    def create(self):
+        make_directory(os.path.dirname(os.path.abspath(self.filename)))
+        header = np.zeros(1,dtype=HEADER_DTYPE)
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['header_size'] = HEADER_DTYPE.itemsize
+        header['capacity'] = self.capacity
+        header['record_size'] = SAMPLE_DTYPE.itemsize
+        # Never truncate the file in place, the readers that have it
+        # mapped would crash (SIGBUS) reading beyond its new end.
+        def write(ring_file):
+            ring_file.write(header.tobytes())
+            ring_file.truncate(self.file_size())
+        write_file(self.filename,write)
+
+    @property
+    def sequence(self):
+        return(int(self.header['sequence'][0]))
+
+    def append(self,record):
+        ''' Write a SAMPLE_DTYPE record (see sample_record) '''
+        sequence = self.sequence
+        self.records[sequence%self.capacity] = record
+        self.header['sequence'] = sequence+1
+
+    def close(self):
+        self.header.flush()
+        self.records.flush()
+        del self.header,self.records
+
+
+class RingReader(object):
+    '''
+    Read the newest samples of a ring buffer file:
+
+     reader = RingReader(filename)
+     last = reader.latest(10)           # last 10 samples, oldest first
+     new,position = reader.read(position)   # samples since the last call
+    '''
+    def __init__(self,filename):
+        self.filename = filename
+        self.open()
+
+    def open(self):
+        # Header, inode and maps from the same open file
+        ring_file = open(self.filename,'rb')
+        try:
+            inode = os.fstat(ring_file.fileno()).st_ino
+            content = ring_file.read(HEADER_DTYPE.itemsize)
+            header = None
+            if len(content)==HEADER_DTYPE.itemsize:
+                header = np.frombuffer(content,dtype=HEADER_DTYPE)[0]
+            if header is None or not valid_header(header) or \
+             os.fstat(ring_file.fileno()).st_size<HEADER_DTYPE.itemsize+\
+             int(header['capacity'])*SAMPLE_DTYPE.itemsize:
+                raise ValueError('Not a PySQM ring buffer file: '+self.filename)
+            capacity = int(header['capacity'])
+            self.header = np.memmap(ring_file,dtype=HEADER_DTYPE,mode='r',shape=(1,))
+            self.records = np.memmap(ring_file,dtype=SAMPLE_DTYPE,mode='r',\
+             offset=HEADER_DTYPE.itemsize,shape=(capacity,))
+        finally:
+            ring_file.close()
+        self.inode = inode
+        self.capacity = capacity
+
+    @property
+    def sequence(self):
+        return(int(self.header['sequence'][0]))
+
+    def check(self):
+        # The writer created a new file (renamed over the old one, that
+        # we still have mapped): map the new one.
+        try: inode = os.stat(self.filename).st_ino
+        except OSError: return
+        if inode!=self.inode:
+            self.open()
+
+    def read(self,since=None,count=None):
+        '''
+        Records from number since (default: the oldest available) to the
+        newest one, at most count (and at most capacity-1, see the notes
+        of the module). Return (records, sequence); pass the sequence as
+        since in the next call to get only the new records.
+        '''
+        self.check()
+        sequence = self.sequence
+        # The writer started a new file, read it from the beginning
+        if since is not None and since>sequence: since = 0
+        # The slot of record sequence-capacity is the next one written
+        first = sequence-self.capacity+1
+        if since is not None: first = max(first,int(since))
+        if count is not None: first = max(first,sequence-int(count))
+        first = max(first,0)
+        numbers = np.arange(first,sequence)
+        records = self.records[numbers%self.capacity].copy()
+        # The slot being written now is the one of record sequence_now,
+        # discard it (and the older ones) if we copied it.
+        sequence_now = self.sequence
+        valid = numbers>sequence_now-self.capacity
+        return(np.asarray(records[valid]).view(np.ndarray),sequence)
+
+    def latest(self,count=1):
+        ''' Last count records, oldest first '''
+        return(self.read(count=count)[0])
+
+    def close(self):
+        del self.header,self.records
+
+
+def open_writer(config):
+    '''
+    RingWriter of the file set in the config (_ringbuffer_file),
+    None if it is not configured.
+    '''
+    try: config._ringbuffer_file
+    except: config._ringbuffer_file = None
+    try: config._ringbuffer_capacity
+    except: config._ringbuffer_capacity = DEFAULT_CAPACITY
+
+    if config._ringbuffer_file is None:
+        return(None)
+    try:
+        return(RingWriter(config._ringbuffer_file,config._ringbuffer_capacity))
+    except Exception as e:
+        print('Warning: cannot open the ring buffer file: '+str(e))
+        return(None)
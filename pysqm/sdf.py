@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+
+'''
+PySQM SDF file loader
+____________________________
+
+Copyright (c) Miguel Nievas <miguelnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Read files in the community standard for skyglow observations (SDF)
+into numpy column arrays. The data lines are split in bulk, a chunk
+of the file at a time, instead of line by line.
+
+follow() yields the records of a file (or the newest file of a
+directory) as they are appended:
+
+ for record in sdf.follow(config.daily_data_directory):
+     print(record.utcdate,record.night_sb)
+____________________________
+'''
+
+import os
+import time
+import datetime
+from collections import namedtuple
+from operator import methodcaller
+import numpy as np
+
+# Fields in each data line:
+# UTC Date & Time, Local Date & Time, Temperature, Counts, Frequency, MSAS
+FIELDS = 6
+
+# Data line as the daemon writes it (SQM.format_content in read.py)
+DATA_LINE_FORMAT = '%s;%s;%.2f;%.3f;%.3f;%.3f\n'
+
+# Bytes read from the file in each step
+CHUNK_SIZE = 4*1024*1024
+
+
+def parse_metadata(header_lines):
+    '''
+    Get the metadata from the header lines (# Key: value)
+    Return a dict
+    '''
+    metadata = {}
+    for line in header_lines:
+        line = line.lstrip('#').strip()
+        if ':' not in line: continue
+        key,value = line.split(':',1)
+        metadata[key.strip()] = value.strip()
+    return(metadata)
+
+
+def split_header(text):
+    '''
+    Separate the header block (lines starting with #) at the beginning
+    of the text. Return the header lines and the remaining text.
+    '''
+    header_lines = []
+    pos = 0
+    while text.startswith('#',pos):
+        end = text.find('\n',pos)
+        if end<0: end = len(text)
+        header_lines.append(text[pos:end].rstrip('\r'))
+        pos = end+1
+    return(header_lines,text[pos:])
+
+
+# Number of ; in a line (map is faster than a loop)
+count_separators = methodcaller('count',';')
+
+def split_fields(text):
+    '''
+    Split complete data lines in a (N,FIELDS) array of strings.
+    Blank, comment and malformed lines are skipped.
+    '''
+    text = text.replace('\r','').replace(' ','')
+    lines = text.split('\n')
+    if lines[-1]=='': lines.pop()
+    fields = ';'.join(lines).split(';')
+
+    # Each line must have FIELDS fields: checking only the total would
+    # accept p.e. a line with one more field next to one with one less,
+    # and shift all the rows after them.
+    if len(fields)!=FIELDS*len(lines) or \
+     set(map(count_separators,lines))!=set([FIELDS-1]):
+        # Slow path, only if there are lines to skip
+        lines = [line for line in lines \
+         if line!='' and line[0]!='#' and line.count(';')==FIELDS-1]
+        fields = ';'.join(lines).split(';')
+
+    if len(lines)==0:
+        return(np.empty((0,FIELDS),dtype='S1'))
+
+    return(np.array(fields).reshape(-1,FIELDS))
+
+
+def parse_datetimes(str_datetimes):
+    '''
+    Convert an array of ISO date strings (YYYY-MM-DDTHH:mm:ss.fff)
+    to datetime64[s]. Incomplete times (YYYY-MM-DDTHH, YYYY-MM-DDTHH:mm)
+    are accepted, the missing fields are set to 0. Rows that are not
+    a date are NaT.
+    '''
+    str_datetimes = np.asarray(str_datetimes)
+    # Drop the fraction of second
+    str_datetimes = str_datetimes.astype(str_datetimes.dtype.kind+'19')
+    try:
+        return(str_datetimes.astype('datetime64[s]'))
+    except ValueError:
+        # Some dates are not ISO (p.e. not zero padded), parse them
+        # one by one instead of failing for the whole file.
+        return(np.array([parse_datetime(str_datetime) \
+         for str_datetime in str_datetimes],dtype='datetime64[s]'))
+
+
+def parse_datetime(str_datetime):
+    '''
+    Parse one date string field by field (YYYY-M-DTH:m:s also works).
+    Return a datetime64[s], NaT if it is not a date.
+    '''
+    str_datetime = decode(str_datetime)
+    try:
+        return(np.datetime64(str_datetime,'s'))
+    except ValueError:
+        pass
+    try:
+        str_date,str_time = str_datetime.split('T')
+        year,month,day = [int(value) for value in str_date.split('-')]
+        # Time may be not complete
+        time_fields = (str_time.split(':')+['0','0'])[0:3]
+        hour,minute = int(time_fields[0]),int(time_fields[1])
+        second = int(float(time_fields[2]))
+        return(np.datetime64(datetime.datetime(year,month,day,hour,minute,second),'s'))
+    except ValueError:
+        return(np.datetime64('NaT','s'))
+
+
+def observing_nights(localdates):
+    '''
+    Observing night of each row: the date of the local time
+    minus 12 hours. Return a datetime64[D] array.
+    '''
+    localdates = np.asarray(localdates,dtype='datetime64[s]')
+    return((localdates-np.timedelta64(12,'h')).astype('datetime64[D]'))
+
+
+def split_nights(localdates):
+    '''
+    Assign each row (local datetime64) to its observing night.
+    Return a list of (night, rows) sorted by night, with night
+    a datetime.date and rows a slice if the file is sorted in time
+    (the usual case) or an array of indices otherwise.
+    '''
+    nights = observing_nights(localdates)
+    if len(nights)==0:
+        return([])
+
+    if np.all(nights[1:]>=nights[:-1]):
+        order = None
+    else:
+        order = np.argsort(nights,kind='mergesort')
+        nights = nights[order]
+
+    bounds = np.concatenate([[0],\
+     np.flatnonzero(nights[1:]!=nights[:-1])+1,[len(nights)]])
+
+    return([(nights[begin].item(),\
+     slice(begin,end) if order is None else order[begin:end]) \
+     for begin,end in zip(bounds[:-1],bounds[1:])])
+
+
+class SDFData(object):
+    '''
+    Columns of a SDF file.
+    Dates are kept as strings, the rest are float arrays.
+    '''
+    def __init__(self,fields=None,metadata=None):
+        if fields is None:
+            fields = np.empty((0,FIELDS),dtype='S1')
+        self.metadata = metadata if metadata is not None else {}
+        self.utc_str      = fields[:,0]
+        self.local_str    = fields[:,1]
+        self.temperatures = fields[:,2].astype(float)
+        self.tick_counts  = fields[:,3].astype(float)
+        self.frequencies  = fields[:,4].astype(float)
+        self.night_sbs    = fields[:,5].astype(float)
+
+    def __len__(self):
+        return(np.size(self.night_sbs))
+
+    def select(self,rows):
+        # New SDFData with only the given rows (slice, indices or mask)
+        Selected = SDFData(metadata=self.metadata)
+        for column in ['utc_str','local_str','temperatures',\
+         'tick_counts','frequencies','night_sbs']:
+            setattr(Selected,column,getattr(self,column)[rows])
+        return(Selected)
+
+    def extend(self,other):
+        # Append the rows of other SDFData
+        for column in ['utc_str','local_str','temperatures',\
+         'tick_counts','frequencies','night_sbs']:
+            setattr(self,column,np.concatenate(\
+             [getattr(self,column),getattr(other,column)]))
+
+
+def decode(text):
+    # Python 3 reads bytes from files open in binary mode
+    if not isinstance(text,str): text = text.decode('latin-1')
+    return(text)
+
+
+class SDFTail(object):
+    '''
+    Follow a SDF file that grows (p.e. the current data file).
+    Each read only parses the complete lines appended since the
+    previous read. If the file was truncated or replaced by a different
+    one (new night), it is read again from the beginning and
+    self.restarted is set to True.
+    '''
+    def __init__(self,filename,chunk_size=CHUNK_SIZE):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.last_line = ''
+        self.metadata = {}
+        self.header_read = False
+
+    def changed(self,sdf_file):
+        '''
+        Check that the file still contains, at the same position,
+        the last line we read. The file is rewritten (not only
+        appended) each time the data is saved.
+        '''
+        if self.offset==0: return(False)
+        sdf_file.seek(0,2)
+        if sdf_file.tell()<self.offset: return(True)
+        sdf_file.seek(self.offset-len(self.last_line))
+        return(decode(sdf_file.read(len(self.last_line)))!=self.last_line)
+
+    def read(self,whole_file=False):
+        '''
+        Return a SDFData with the new rows. A last line without end of
+        line is left for the next read (it may be being written), unless
+        whole_file is True.
+        '''
+        sdf_file = open(self.filename,'rb')
+        self.restarted = self.changed(sdf_file)
+        if self.restarted: self.reset()
+
+        sdf_file.seek(self.offset)
+        Data = SDFData(metadata=self.metadata)
+        remainder = ''
+        while True:
+            chunk = decode(sdf_file.read(self.chunk_size))
+            text = remainder+chunk
+            if not self.header_read:
+                header_lines,data_text = split_header(text)
+                if data_text=='' and (chunk or not whole_file):
+                    # Header may be incomplete, wait for the data lines
+                    remainder = text
+                    if chunk: continue
+                    else: break
+                self.metadata.update(parse_metadata(header_lines))
+                self.header_read = True
+                self.offset += len(text)-len(data_text)
+                text = data_text
+            # Only complete lines. Keep the last one for the next step
+            cut = text.rfind('\n')+1
+            if whole_file and not chunk: cut = len(text)
+            text,remainder = text[:cut],text[cut:]
+            if text:
+                Data.extend(SDFData(split_fields(text)))
+                self.offset += len(text)
+                self.last_line = text[text.rfind('\n',0,len(text)-1)+1:]
+            if not chunk: break
+
+        sdf_file.close()
+        return(Data)
+
+
+def load_sdf(filename,chunk_size=CHUNK_SIZE):
+    '''
+    Read a SDF file.
+    Only the header block is used to get the metadata.
+    Return a SDFData object
+    '''
+    return(SDFTail(filename,chunk_size).read(whole_file=True))
+
+
+SDFRecord = namedtuple('SDFRecord',\
+ ['utcdate','localdate','temperature','tick_counts','frequency','night_sb'])
+
+
+def newest_file(directory):
+    # Last .dat file of the directory by name (daily files start with the date)
+    try: names = [name for name in os.listdir(directory) if name.endswith('.dat')]
+    except OSError: return(None)
+    if not names: return(None)
+    return(os.path.join(directory,max(names)))
+
+
+def file_signature(filename):
+    # Changes when the file is written or replaced. None if it doesnt exist.
+    try: stat = os.stat(filename)
+    except OSError: return(None)
+    return(stat.st_ino,stat.st_size,stat.st_mtime)
+
+
+def follow(path,batches=False,from_end=False,min_interval=1.,\
+ max_interval=60.,timeout=None,chunk_size=CHUNK_SIZE):
+    '''
+    Generator with the data appended to a SDF file as it grows.
+    path is a file (p.e. the current data file) or a directory; in
+    that case the newest .dat file is followed, and when a new one
+    appears (next night) the rest of the old one is read and the
+    new one is followed from its beginning.
+    Only complete lines are returned, the offset in the file is kept
+    and a file that is rewritten with other content is read again.
+
+    Yields SDFRecord tuples (utcdate and localdate as datetime, None
+    if they are not valid), or SDFData blocks with all the new rows
+    if batches is True. With from_end, the data already in the file
+    is skipped. The file is checked each min_interval seconds, doubling
+    the wait (up to max_interval) while there is nothing new. Stops
+    after timeout seconds without new data (None: never).
+    '''
+    tail = None
+    signature = None
+    interval = min_interval
+    waited = 0.
+    while True:
+        filename = newest_file(path) if os.path.isdir(path) else path
+        blocks = []
+        try:
+            if tail is not None and tail.filename!=filename:
+                # Rest of the previous file, if it still exists
+                old,tail = tail,None
+                try: blocks.append(old.read(whole_file=True))
+                except (IOError,OSError): pass
+            if tail is None and filename is not None:
+                tail = SDFTail(filename,chunk_size)
+                signature = None
+            current = file_signature(filename) if filename else None
+            if current is not None and current!=signature:
+                signature = current
+                blocks.append(tail.read())
+                if from_end:
+                    blocks,from_end = [],False
+        except (IOError,OSError):
+            # Removed while reading, check again in the next step
+            signature = None
+
+        blocks = [Data for Data in blocks if len(Data)>0]
+        if not blocks:
+            if timeout is not None and waited>=timeout:
+                return
+            time.sleep(interval)
+            waited += interval
+            interval = min(2*interval,max_interval)
+            continue
+
+        interval = min_interval
+        waited = 0.
+        for Data in blocks:
+            if batches:
+                yield(Data)
+            else:
+                for record in zip(parse_datetimes(Data.utc_str).tolist(),\
+                 parse_datetimes(Data.local_str).tolist(),\
+                 Data.temperatures.tolist(),Data.tick_counts.tolist(),\
+                 Data.frequencies.tolist(),Data.night_sbs.tolist()):
+                    yield(SDFRecord(*record))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+'''
+PySQM daemon startup
+____________________________
+
+Copyright (c) Miguel Nievas <miguelnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+start_services starts the optional services of the daemon (metrics,
+profiling...) selected in the config. It is used by pysqm.main.
+
+Startup benchmark. Measures, in new python processes, the time to
+load the modules and services the daemon needs before connecting to
+the photometer (the connection itself needs the device, see the
+"Startup time" printed by the daemon):
+
+ python -m pysqm.startup -c config.py [-n 20]
+
+It prints the min/median/max times and the heavy modules that were
+loaded (matplotlib should never be there).
+____________________________
+'''
+
+import os,sys
+import time
+import argparse
+import subprocess
+
+
+def start_services(config):
+    '''
+    Start the services requested in the config.
+    Return a dict with the objects the main loop needs.
+    '''
+    import pysqm.metrics as metrics
+
+    # Export the runtime metrics (if configured)
+    metrics.start(config)
+
+    # Serve the data and plots over HTTP (if configured)
+    if getattr(config,'_api_port',None) is not None:
+        import pysqm.httpapi
+        pysqm.httpapi.start(config)
+
+    # Last samples in a memory mapped file (if configured)
+    ring_writer = None
+    if getattr(config,'_ringbuffer_file',None) is not None:
+        import pysqm.ringbuffer
+        ring_writer = pysqm.ringbuffer.open_writer(config)
+
+    # Send the samples to local subscribers (if configured)
+    publisher = None
+    if getattr(config,'_publish_socket',None) is not None or \
+     getattr(config,'_publish_multicast',None) is not None:
+        import pysqm.publish
+        publisher = pysqm.publish.open_publisher(config)
+
+    # Signal triggered profiling (SIGUSR1: cProfile, SIGUSR2: stacks/memory)
+    import pysqm.profiling
+    profiler = pysqm.profiling.install(config)
+
+    return({'ring_writer':ring_writer,'publisher':publisher,'profiler':profiler})
+
+
+# Modules that should only be loaded if the config needs them
+HEAVY_MODULES = ['matplotlib','pysqm.plot','multiprocessing','sqlite3',\
+ 'BaseHTTPServer','http.server','pysqm.reprocess','pysqm.httpapi',\
+ 'pysqm.ringbuffer','pysqm.publish']
+
+# Run in a new process: same steps as pysqm.main before the device
+BENCHMARK_CODE = '''
+import time
+start = time.time()
+import sys
+import pysqm.settings as settings
+settings.GlobalConfig.read_config_file(sys.argv[1])
+config = settings.GlobalConfig.config
+from pysqm.read import *
+import pysqm.startup
+pysqm.startup.start_services(config)
+elapsed = time.time()-start
+sys.stdout.write('%.6f %s\\n' %(elapsed,','.join(\\
+ [name for name in pysqm.startup.HEAVY_MODULES if name in sys.modules])))
+'''
+
+
+def measure(config_filename,repetitions=10):
+    '''
+    Start repetitions python processes. Return the list of
+    (total seconds, import seconds, loaded heavy modules).
+    '''
+    results = []
+    devnull = open(os.devnull,'w')
+    for k in range(repetitions):
+        start = time.time()
+        output = subprocess.check_output([sys.executable,'-c',BENCHMARK_CODE,\
+         config_filename],stderr=devnull)
+        total = time.time()-start
+        line = output.decode('latin-1').strip().split('\n')[-1]
+        elapsed,modules = (line.split(' ',1)+[''])[0:2]
+        results.append((total,float(elapsed),modules.split(',') if modules else []))
+    devnull.close()
+    return(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pysqm.startup',\
+     description='Measure the startup time of the daemon (without the device)')
+    parser.add_argument('-c','--config',default='config.py',\
+     help='configuration file')
+    parser.add_argument('-n','--repetitions',type=int,default=10,\
+     help='number of processes to start (default: 10)')
+    args = parser.parse_args(argv)
+
+    results = measure(os.path.abspath(args.config),args.repetitions)
+    for name,column in [('process',0),('modules',1)]:
+        times = sorted([result[column] for result in results])
+        print('%-8s min %.3f s  median %.3f s  max %.3f s' %(\
+         name,times[0],times[len(times)//2],times[-1]))
+    print('heavy modules loaded: '+(', '.join(results[-1][2]) or 'none'))
+    return(0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
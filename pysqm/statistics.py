@@ -0,0 +1,689 @@
+#!/usr/bin/env python
+
+'''
+PySQM night statistics store
+____________________________
+
+Copyright (c) Miguel Nievas <miguelnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+The summary statistics (one row per night) are kept in a sqlite
+table indexed by the night, so saving the statistics of a night
+doesnt need to read or rewrite the whole archive. The classic CSV
+file (Statistics_<device>_<observatory>.dat) is exported from it.
+Several processes can write to the same store.
+
+night_statistics computes the statistics of many nights at once
+(p.e. all the nights of a monthly file) with array operations, and
+summary_tables groups them by month and year. classify_samples
+flags each sample as twilight, moon up or dark (moonless night).
+
+The store also keeps, for each night, the median NSB in bins of
+local time (time_of_night_bins), used for the long-term heatmap.
+
+NightAccumulator gets the samples one by one during the acquisition
+and gives the same statistics as night_statistics at the end of the
+night, without reading the data file again.
+____________________________
+'''
+
+import os,sys
+import sqlite3
+import warnings
+from array import array
+import numpy as np
+
+from pysqm.common import set_decimals
+from pysqm.cache import write_file
+
+# (column, sqlite type, decimals in the CSV file or None, description)
+COLUMNS = [\
+ ('night','TEXT PRIMARY KEY',None,'Date'),\
+ ('number','INTEGER',None,'Total measures'),\
+ ('bests_number','INTEGER',None,'Number of Best NSB measures'),\
+ ('bests_median','REAL',4,'Median of best N NSBs (mag/arcsec2)'),\
+ ('bests_err','REAL',4,'Err in the median of best N NSBs (mag/arcsec2)'),\
+ ('model_nterm','INTEGER',None,'Number of terms of the low-freq fourier model'),\
+ ('data_model_abs_meandiff','REAL',3,\
+  'Mean of Abs diff of NSBs data - fourier model (mag/arcsec2)'),\
+ ('min_temperature','REAL',1,'Min Temp (C) between astronomical twilights'),\
+ ('max_temperature','REAL',1,'Max Temp (C) between astronomical twilights')]
+
+COLUMN_NAMES = [column[0] for column in COLUMNS]
+
+
+def csv_header(device_name):
+    '''
+    Header of the CSV statistics file
+    '''
+    return(\
+     '# Summary statistics for '+str(device_name)+'\n'+\
+     '# Description of columns (CSV file):\n'+\
+     ''.join(['# Col %d: %s\n' %(k+1,column[3]) for k,column in enumerate(COLUMNS)])+\
+     '\n')
+
+
+def format_row(row):
+    # One line of the CSV file
+    return(';'.join([str(value) if decimals is None \
+     else set_decimals(value,decimals) \
+     for value,(name,sqltype,decimals,description) in zip(row,COLUMNS)])+'\n')
+
+
+def parse_csv(content):
+    '''
+    Get the rows from the content of a CSV statistics file.
+    Comment, blank and malformed lines are skipped.
+    '''
+    rows = []
+    for line in content.split('\n'):
+        if '#' in line or line.strip()=='':
+            continue
+        values = line.strip().split(';')
+        if len(values)!=len(COLUMNS):
+            continue
+        try:
+            rows.append([values[0]]+[\
+             int(value) if column[1]=='INTEGER' else float(value) \
+             for value,column in zip(values[1:],COLUMNS[1:])])
+        except ValueError:
+            continue
+    return(rows)
+
+
+def last_csv_night(filename):
+    '''
+    Night (YYYY-MM-DD) of the last row of a CSV statistics file, reading
+    only the end of the file. None if there is no file or no complete row.
+    '''
+    try: thefile = open(filename,'rb')
+    except IOError: return(None)
+    thefile.seek(0,2)
+    thefile.seek(max(0,thefile.tell()-4096))
+    content = thefile.read()
+    thefile.close()
+    if not isinstance(content,str): content = content.decode('latin-1')
+    # The first line may be incomplete, only the last one is used
+    rows = parse_csv(content)
+    if not rows or not content.endswith('\n'): return(None)
+    return(str(rows[-1][0]))
+
+
+class StatisticsStore(object):
+    '''
+    Statistics of each night, in a sqlite database
+    '''
+    def __init__(self,filename,timeout=30):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename,timeout=timeout)
+        self.connection.execute(\
+         'CREATE TABLE IF NOT EXISTS nights (%s)' %\
+         ', '.join(['%s %s' %(column[0],column[1]) for column in COLUMNS]))
+        # layout identifies the bins (see time_of_night_bins)
+        self.connection.execute(\
+         'CREATE TABLE IF NOT EXISTS night_bins '+\
+         '(night TEXT, layout TEXT, bins BLOB, PRIMARY KEY (night, layout))')
+        self.connection.commit()
+
+    def __len__(self):
+        return(self.connection.execute('SELECT COUNT(*) FROM nights').fetchone()[0])
+
+    def upsert(self,rows,replace=True):
+        '''
+        Insert the rows (sequences ordered as COLUMNS),
+        replacing the existing ones for the same nights
+        (or keeping them if replace is False).
+        '''
+        with self.connection:
+            self.connection.executemany(\
+             'INSERT OR %s INTO nights (%s) VALUES (%s)' %(\
+             'REPLACE' if replace else 'IGNORE',\
+             ', '.join(COLUMN_NAMES),', '.join(['?']*len(COLUMNS))),\
+             [[str(row[0])]+list(row[1:]) for row in rows])
+
+    def save_night(self,night,Stat):
+        ''' Insert or replace the statistics (Stat object) of a night '''
+        self.upsert([[night]+[getattr(Stat,name) for name in COLUMN_NAMES[1:]]])
+
+    def read(self,first=None,last=None):
+        '''
+        Return the rows of the nights between first and last
+        (both included, dates or YYYY-MM-DD strings), sorted by night.
+        '''
+        conditions,arguments = [],[]
+        if first is not None:
+            conditions.append('night >= ?')
+            arguments.append(str(first))
+        if last is not None:
+            conditions.append('night <= ?')
+            arguments.append(str(last))
+        query = 'SELECT %s FROM nights' %', '.join(COLUMN_NAMES)
+        if conditions:
+            query += ' WHERE '+' AND '.join(conditions)
+        return(self.connection.execute(query+' ORDER BY night',arguments).fetchall())
+
+    def save_night_bins(self,night,layout,bins):
+        ''' Insert or replace the time of night bins of a night '''
+        with self.connection:
+            self.connection.execute(\
+             'INSERT OR REPLACE INTO night_bins (night, layout, bins) VALUES (?, ?, ?)',\
+             (str(night),layout,sqlite3.Binary(np.asarray(bins,dtype='<f4').tobytes())))
+
+    def read_night_bins(self,layout,first=None,last=None):
+        '''
+        Return the nights (datetime64[D] array) with bins for the
+        given layout, between first and last, and a matrix with the
+        bins of each night (one row per night).
+        '''
+        conditions,arguments = ['layout = ?'],[layout]
+        if first is not None:
+            conditions.append('night >= ?')
+            arguments.append(str(first))
+        if last is not None:
+            conditions.append('night <= ?')
+            arguments.append(str(last))
+        rows = self.connection.execute(\
+         'SELECT night, bins FROM night_bins WHERE '+' AND '.join(conditions)+\
+         ' ORDER BY night',arguments).fetchall()
+        nights = np.array([str(row[0]) for row in rows],dtype='datetime64[D]')
+        bins = [np.frombuffer(bytes(row[1]),dtype='<f4') for row in rows]
+        if not bins:
+            return(nights,np.empty((0,0),dtype='<f4'))
+        return(nights,np.vstack(bins))
+
+    def import_csv(self,filename):
+        '''
+        Load the rows of an existing CSV statistics file. The nights
+        already in the store (p.e. just saved by another process) are
+        not replaced.
+        '''
+        thefile = open(filename,'r')
+        rows = parse_csv(thefile.read())
+        thefile.close()
+        self.upsert(rows,replace=False)
+        return(len(rows))
+
+    def export_csv(self,filename,device_name,first=None,last=None):
+        '''
+        Write the rows in the CSV layout. The file is replaced
+        atomically, readers never see a partial file.
+        '''
+        def write(thefile):
+            thefile.write(csv_header(device_name))
+            for row in self.read(first,last):
+                thefile.write(format_row(row))
+        write_file(filename,write,'w')
+
+    def update_csv(self,filename,device_name,night):
+        '''
+        Write the row of a night in the CSV file. If the night is after
+        the last one of the file (the usual case: the night that just
+        ended) the row is appended, otherwise the whole file is exported.
+        '''
+        rows = self.read(night,night)
+        last = last_csv_night(filename)
+        if rows and last is not None and str(night)>last:
+            thefile = open(filename,'a')
+            thefile.write(format_row(rows[0]))
+            thefile.close()
+        else:
+            self.export_csv(filename,device_name)
+
+    def close(self):
+        self.connection.close()
+
+
+# Statistics of a night (see night_statistics)
+NIGHT_STATS_DTYPE = np.dtype([\
+ ('night','datetime64[D]'),('number',int),('astronomical',bool),\
+ ('mean',float),('median',float),('std',float),\
+ ('bests_number',int),('bests_mean',float),('bests_median',float),\
+ ('bests_std',float),('bests_err',float),('model_nterm',int),\
+ ('data_model_abs_meandiff',float),\
+ ('min_temperature',float),('max_temperature',float)])
+
+# Summary of a period (see summary_tables)
+SUMMARY_DTYPE = np.dtype([\
+ ('period','S7'),('nights',int),('number',int),\
+ ('bests_median',float),('bests_median_min',float),('bests_median_max',float),\
+ ('median',float),('min_temperature',float),('max_temperature',float)])
+
+
+# Sky conditions of a sample (see classify_samples)
+TWILIGHT = 0
+MOON_UP  = 1
+DARK     = 2
+
+
+def interval_bounds(intervals):
+    '''
+    Merge the (start, end) intervals (datetimes).
+    Return the sorted datetime64 bounds [start0, end0, start1, end1, ...]
+    '''
+    if len(intervals)==0:
+        return(np.array([],dtype='datetime64[s]'))
+    starts = np.array([np.datetime64(start,'s') for start,end in intervals])
+    ends   = np.array([np.datetime64(end,'s') for start,end in intervals])
+    order = np.argsort(starts,kind='mergesort')
+    starts,ends = starts[order],ends[order]
+
+    # New group when the interval starts after all the previous ends
+    max_ends = np.maximum.accumulate(ends.astype(np.int64))
+    new_group = np.concatenate([[True],starts[1:].astype(np.int64)>max_ends[:-1]])
+    group_starts = np.flatnonzero(new_group)
+    group_ends = np.maximum.reduceat(max_ends,group_starts).astype('datetime64[s]')
+    return(np.column_stack([starts[group_starts],group_ends]).ravel())
+
+
+def in_intervals(times,intervals):
+    '''
+    True for the times (datetime64) inside any of the open
+    (start, end) intervals. Uses a binary search on the bounds,
+    times doesnt need to be sorted.
+    '''
+    bounds = interval_bounds(intervals)
+    times = np.asarray(times,dtype='datetime64[s]')
+    right = np.searchsorted(bounds,times,side='right')
+    left  = np.searchsorted(bounds,times,side='left')
+    # Odd position: after a start and before its end. Not on a bound.
+    return((right%2==1)*(right==left))
+
+
+def classify_samples(utcdates,twilights,moon_up):
+    '''
+    Sky conditions of each sample (UTC datetime64 array, any
+    number of nights):
+     - TWILIGHT: outside the astronomical nights
+     - MOON_UP: astronomical night, moon above the horizon
+     - DARK: astronomical night, moon below the horizon
+    twilights and moon_up are lists of (start, end) UTC datetimes:
+    the astronomical nights and the periods with the moon up.
+    Return an int8 array.
+    '''
+    night = in_intervals(utcdates,twilights)
+    moon  = in_intervals(utcdates,moon_up)
+    conditions = np.full(np.size(night),TWILIGHT,dtype=np.int8)
+    conditions[night*moon] = MOON_UP
+    conditions[night*~moon] = DARK
+    return(conditions)
+
+
+def fourier_residuals(matrix,nterms):
+    '''
+    Mean of the abs differences between each row of matrix and its
+    fourier model with the first nterms[row] terms.
+    '''
+    matrix_fft = np.fft.fft(matrix,axis=1)
+    matrix_fft[np.arange(matrix.shape[1])>=nterms[:,None]] = 0
+    residuals = matrix-np.fft.ifft(matrix_fft,axis=1)
+    return(np.mean(np.abs(residuals),axis=1))
+
+
+def night_statistics(nights,night_sbs,temperatures,utcdates=None,\
+ twilights=None,min_astronomical=10,mask=None):
+    '''
+    Statistics of many nights at once.
+     - nights: list of (night, rows), as returned by sdf.split_nights
+     - night_sbs, temperatures, utcdates: columns of the data
+     - twilights: list of (evening, morning) astronomical twilights
+       (datetime) of each night.
+    Only the data between twilights is used, unless there are less
+    than min_astronomical points (then the whole night is used,
+    and astronomical is False).
+     - mask: use only these rows of the data instead (p.e. the DARK
+       ones from classify_samples). Nights without data get nan.
+    Return an array of NIGHT_STATS_DTYPE, one row per night.
+    '''
+    number_of_nights = len(nights)
+    stats = np.zeros(number_of_nights,dtype=NIGHT_STATS_DTYPE)
+    if number_of_nights==0:
+        return(stats)
+    stats['night'] = [night for night,rows in nights]
+
+    # Rows of all the nights, grouped by night (group = night index)
+    indices = [np.arange(len(night_sbs))[rows] for night,rows in nights]
+    lengths = np.array([len(index) for index in indices])
+    indices = np.concatenate(indices)
+    group = np.repeat(np.arange(number_of_nights),lengths)
+
+    if mask is not None:
+        selected = np.asarray(mask)[indices]
+        stats['astronomical'] = twilights is not None
+    elif twilights is not None:
+        selected = in_intervals(np.asarray(utcdates)[indices],twilights)
+        stats['astronomical'] = \
+         np.bincount(group,weights=selected,minlength=number_of_nights)>min_astronomical
+        selected |= ~stats['astronomical'][group]
+    else:
+        selected = np.ones(len(indices),dtype=bool)
+
+    indices,group = indices[selected],group[selected]
+    number = np.bincount(group,minlength=number_of_nights)
+
+    # Matrix with a row per night (in time order), padded with nan
+    starts = np.concatenate([[0],np.cumsum(number)[:-1]])
+    column = np.arange(len(group))-starts[group]
+    sb_matrix = np.full((number_of_nights,max(1,number.max())),np.nan)
+    sb_matrix[group,column] = np.asarray(night_sbs)[indices]
+    temp_matrix = np.full(sb_matrix.shape,np.nan)
+    temp_matrix[group,column] = np.asarray(temperatures)[indices]
+
+    # Nights without data (only with mask) give nan, dont warn
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',RuntimeWarning)
+
+        stats['number'] = number
+        stats['mean']   = np.nanmean(sb_matrix,axis=1)
+        stats['median'] = np.nanmedian(sb_matrix,axis=1)
+        # Kept as in the previous versions (it is the median)
+        stats['std']    = stats['median']
+
+        # Only the best 1/50th. Select the largest values of each night
+        # (partial sort) and sort only those.
+        bests_number = (1+number/50.).astype(int)
+        kmax = bests_number.max()
+        bests = -np.partition(np.where(np.isnan(sb_matrix),np.inf,-sb_matrix),\
+         kmax-1,axis=1)[:,:kmax]
+        bests = np.sort(bests,axis=1)[:,::-1]
+        bests[np.arange(kmax)>=bests_number[:,None]] = np.nan
+
+        stats['bests_number'] = bests_number
+        stats['bests_mean']   = np.nanmean(bests,axis=1)
+        stats['bests_median'] = np.nanmedian(bests,axis=1)
+        stats['bests_std']    = np.nanstd(bests,axis=1)
+        stats['bests_err']    = stats['bests_std']/np.sqrt(bests_number)
+
+        # Fourier model, batched by the number of points in the night
+        stats['model_nterm'] = bests_number
+        for length in np.unique(number[number>0]):
+            same_length = np.flatnonzero(number==length)
+            stats['data_model_abs_meandiff'][same_length] = fourier_residuals(\
+             sb_matrix[same_length,:length],bests_number[same_length])
+
+        # Other interesting data
+        stats['min_temperature'] = np.nanmin(temp_matrix,axis=1)
+        stats['max_temperature'] = np.nanmax(temp_matrix,axis=1)
+
+    empty = number==0
+    for field,dtype in NIGHT_STATS_DTYPE.descr:
+        if dtype==np.dtype(float).str:
+            stats[field][empty] = np.nan
+    stats['bests_number'][empty] = 0
+    stats['model_nterm'][empty] = 0
+
+    return(stats)
+
+
+def summary_tables(stats):
+    '''
+    Group the statistics of the nights (NIGHT_STATS_DTYPE) by month and
+    by year. Return a dict {'month': array, 'year': array} of
+    SUMMARY_DTYPE, sorted by period (YYYY-MM or YYYY).
+    '''
+    tables = {}
+    for name,unit in [('month','M'),('year','Y')]:
+        periods = stats['night'].astype('datetime64[%s]' %unit)
+        unique_periods,group = np.unique(periods,return_inverse=True)
+        table = np.zeros(len(unique_periods),dtype=SUMMARY_DTYPE)
+        table['period'] = [str(period) for period in unique_periods]
+        table['nights'] = np.bincount(group,minlength=len(unique_periods))
+        table['number'] = np.bincount(group,weights=stats['number'],\
+         minlength=len(unique_periods))
+
+        # Per period reductions over the nights, sorted by period
+        order = np.argsort(group,kind='mergesort')
+        starts = np.concatenate([[0],np.cumsum(table['nights'])[:-1]])
+        for field,reduction in [\
+         ('bests_median_min',np.minimum),('bests_median_max',np.maximum)]:
+            table[field] = reduction.reduceat(stats['bests_median'][order],starts)
+        table['min_temperature'] = np.minimum.reduceat(stats['min_temperature'][order],starts)
+        table['max_temperature'] = np.maximum.reduceat(stats['max_temperature'][order],starts)
+        table['bests_median'] = [np.median(stats['bests_median'][order][a:a+n]) \
+         for a,n in zip(starts,table['nights'])]
+        table['median'] = [np.median(stats['median'][order][a:a+n]) \
+         for a,n in zip(starts,table['nights'])]
+        tables[name] = table
+    return(tables)
+
+
+def bins_layout(start_hour,hours,bin_minutes):
+    # Name of a bin layout, p.e. 17h+16h/10min
+    return('%gh+%gh/%gmin' %(start_hour,hours,bin_minutes))
+
+
+def time_of_night_bins(localdates,night_sbs,night,start_hour=17,\
+ hours=16,bin_minutes=10):
+    '''
+    Median NSB of a night in bins of bin_minutes of local time,
+    from start_hour of the night date during hours.
+    Return a float array, nan for the bins without data.
+    '''
+    number_of_bins = int(round(hours*60./bin_minutes))
+    start = np.datetime64(night,'D')+np.timedelta64(int(round(start_hour*3600)),'s')
+    seconds = (np.asarray(localdates,dtype='datetime64[s]')-start).astype(np.int64)
+    bin_index = seconds//int(round(bin_minutes*60))
+    inside = (bin_index>=0)*(bin_index<number_of_bins)
+    bin_index = bin_index[inside]
+    values = np.asarray(night_sbs,dtype=float)[inside]
+
+    bins = np.full(number_of_bins,np.nan)
+    if np.size(values)==0:
+        return(bins)
+
+    # Median of each bin: sort by bin and value, take the central ones
+    order = np.lexsort((values,bin_index))
+    values,bin_index = values[order],bin_index[order]
+    counts = np.bincount(bin_index,minlength=number_of_bins)
+    used = np.flatnonzero(counts)
+    starts = np.concatenate([[0],np.cumsum(counts)[:-1]])[used]
+    bins[used] = (values[starts+(counts[used]-1)//2]+values[starts+counts[used]//2])/2.
+    return(bins)
+
+
+class P2Quantile(object):
+    '''
+    Streaming estimate of the p quantile with the P2 algorithm
+    (Jain & Chlamtac 1985): 5 markers, constant memory and time
+    per value. Exact for less than 5 values.
+    '''
+    def __init__(self,p=0.5):
+        self.p = p
+        self.heights = []
+        self.positions = [0,1,2,3,4]
+        self.desired = [0,2*p,4*p,2+2*p,4]
+        self.increments = [0,p/2.,p,(1+p)/2.,1]
+
+    def add(self,x):
+        q,n = self.heights,self.positions
+        if len(q)<5:
+            q.append(x)
+            q.sort()
+            return
+
+        if x<q[0]:
+            q[0] = x
+            k = 0
+        elif x>=q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x>=q[k+1]: k += 1
+        for i in range(k+1,5): n[i] += 1
+        for i in range(5): self.desired[i] += self.increments[i]
+
+        # Move the central markers to their desired positions
+        for i in range(1,4):
+            d = self.desired[i]-n[i]
+            if (d>=1 and n[i+1]-n[i]>1) or (d<=-1 and n[i-1]-n[i]<-1):
+                d = 1 if d>0 else -1
+                height = q[i]+float(d)/(n[i+1]-n[i-1])*(\
+                 (n[i]-n[i-1]+d)*(q[i+1]-q[i])/float(n[i+1]-n[i])+\
+                 (n[i+1]-n[i]-d)*(q[i]-q[i-1])/float(n[i]-n[i-1]))
+                if not q[i-1]<height<q[i+1]:
+                    height = q[i]+d*(q[i+d]-q[i])/float(n[i+d]-n[i])
+                q[i] = height
+                n[i] += d
+
+    @property
+    def value(self):
+        if len(self.heights)==0:
+            return(np.nan)
+        if self.positions[4]<5:
+            return(np.percentile(self.heights,100*self.p))
+        return(self.heights[2])
+
+
+class RunningStatistics(object):
+    '''
+    Counters of a set of samples: number, sum and temperature range.
+    The streaming median (P2) is only for the live metric during the
+    night, the final statistics use the NSB series.
+    '''
+    def __init__(self):
+        self.number = 0
+        self.valid = 0
+        self.total = 0.
+        self.min_temperature = np.nan
+        self.max_temperature = np.nan
+        self.median = P2Quantile(0.5)
+
+    def add(self,night_sb,temperature):
+        # nan values are counted but not used, as in night_statistics
+        self.number += 1
+        if temperature==temperature:
+            if not temperature>=self.min_temperature: self.min_temperature = temperature
+            if not temperature<=self.max_temperature: self.max_temperature = temperature
+        if night_sb!=night_sb:
+            return
+        self.valid += 1
+        self.total += night_sb
+        self.median.add(night_sb)
+
+    @property
+    def bests_number(self):
+        return(int(1+self.number/50.))
+
+
+def buffer_array(values,dtype):
+    # numpy view of an array.array (an empty one has no buffer)
+    if len(values)==0: return(np.zeros(0,dtype=dtype))
+    return(np.frombuffer(values,dtype=dtype))
+
+
+class NightAccumulator(object):
+    '''
+    Statistics of a night updated with each sample (add), so they are
+    ready when the night ends (statistics). Same selection as
+    night_statistics: the samples between the astronomical twilights
+    (evening, morning), or all of them if there are not more than
+    min_astronomical. The NSB series is kept too (float array) for the
+    fourier model and the heatmap bins, which need the whole night.
+    '''
+    def __init__(self,night,twilights=None,min_astronomical=10):
+        self.night = night
+        self.twilights = None
+        if twilights is not None:
+            self.twilights = (np.datetime64(twilights[0],'s'),\
+             np.datetime64(twilights[1],'s'))
+        self.min_astronomical = min_astronomical
+        self.whole = RunningStatistics()
+        self.astronomical = RunningStatistics()
+        self.night_sbs = array('d')
+        self.localdates = array('d')
+        self.in_astronomical = array('b')
+
+    def __len__(self):
+        return(self.whole.number)
+
+    def add(self,utcdate,localdate,night_sb,temperature):
+        # utcdate/localdate: datetime or datetime64
+        night_sb,temperature = float(night_sb),float(temperature)
+        self.whole.add(night_sb,temperature)
+        inside = self.twilights is not None and \
+         bool(self.twilights[0]<np.datetime64(utcdate,'s')<self.twilights[1])
+        if inside:
+            self.astronomical.add(night_sb,temperature)
+        self.night_sbs.append(night_sb)
+        self.localdates.append(np.datetime64(localdate,'s').astype(np.int64))
+        self.in_astronomical.append(inside)
+
+    @property
+    def use_astronomical(self):
+        return(self.astronomical.number>self.min_astronomical)
+
+    def selection(self):
+        '''
+        Running statistics and NSB series used for the night.
+        Return (RunningStatistics, series, astronomical)
+        '''
+        night_sbs = buffer_array(self.night_sbs,float)
+        if self.use_astronomical:
+            inside = buffer_array(self.in_astronomical,np.int8).astype(bool)
+            return(self.astronomical,night_sbs[inside],True)
+        return(self.whole,night_sbs,False)
+
+    @property
+    def median(self):
+        # Running (approximate) median of the NSB, for the live metric
+        if self.use_astronomical:
+            return(self.astronomical.median.value)
+        return(self.whole.median.value)
+
+    def statistics(self):
+        '''
+        Return an array of NIGHT_STATS_DTYPE with one row,
+        as night_statistics for this night.
+        '''
+        stats = np.zeros(1,dtype=NIGHT_STATS_DTYPE)
+        stats['night'] = self.night
+        Running,night_sbs,astronomical = self.selection()
+        stats['astronomical'] = astronomical
+        number = Running.number
+        stats['number'] = number
+        if number==0:
+            for field,dtype in NIGHT_STATS_DTYPE.descr:
+                if dtype==np.dtype(float).str:
+                    stats[field] = np.nan
+            return(stats)
+
+        bests_number = Running.bests_number
+        bests = -np.sort(-night_sbs)[:bests_number]
+
+        stats['mean']   = Running.total/Running.valid if Running.valid else np.nan
+        stats['median'] = np.nanmedian(night_sbs)
+        # Kept as in the previous versions (it is the median)
+        stats['std']    = stats['median']
+        stats['bests_number'] = bests_number
+        stats['bests_mean']   = np.mean(bests)
+        stats['bests_median'] = np.median(bests)
+        stats['bests_std']    = np.std(bests)
+        stats['bests_err']    = stats['bests_std']/np.sqrt(bests_number)
+        stats['model_nterm']  = bests_number
+        stats['data_model_abs_meandiff'] = fourier_residuals(\
+         night_sbs[None,:],np.array([bests_number]))
+        stats['min_temperature'] = Running.min_temperature
+        stats['max_temperature'] = Running.max_temperature
+        return(stats)
+
+    def time_of_night_bins(self,start_hour=17,hours=16,bin_minutes=10):
+        # Heatmap bins of the night (see time_of_night_bins)
+        localdates = buffer_array(self.localdates,float).astype(np.int64)
+        return(time_of_night_bins(localdates.astype('datetime64[s]'),\
+         buffer_array(self.night_sbs,float),self.night,start_hour,hours,bin_minutes))